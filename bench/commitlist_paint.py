@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# Paints the commit list of a synthetic history of ROWS commits (500000 by
+# default) with every row selected, at the top, in the middle and at the
+# end of the history. wx is replaced by objects that do nothing, so only
+# the work of CommitList.OnPaint itself is measured: it should depend on
+# the size of the window, not on the size of the history or the selection.
+#
+# Usage: commitlist_paint.py [ROWS]
+
+import sys
+import time
+import types
+from os.path import realpath, dirname, join
+
+PAINTS = 10
+
+class NoOp(object):
+    # Any attribute, call or instance of a wx class
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        return NoOp()
+
+    def __getattr__(self, name):
+        return NoOp()
+
+    def __or__(self, other):
+        return 0
+    __ror__ = __or__
+
+class NoOpModule(types.ModuleType):
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError, name
+        return NoOp
+
+sys.modules['wx'] = NoOpModule('wx')
+
+sys.path.insert(0, join(dirname(realpath(__file__)), '..', 'stupidgit_gui'))
+import git
+import graphlayout
+import CommitList
+
+def history(count):
+    # A mainline with a short side branch merged every 50 commits
+    records = []
+    for i in xrange(count):
+        parents = []
+        if i+1 < count:
+            parents.append('%040x' % (i+1))
+        if i % 50 == 0 and i+7 < count:
+            parents.append('%040x' % (i+7))
+        records.append(('%040x' % i, parents, 'Author', 1500000000 - 60*i, 60, 'Commit %d' % i))
+    return records
+
+class Size(object):
+    def GetWidth(self):
+        return 800
+
+    def GetHeight(self):
+        return 600
+
+class Region(object):
+    def GetBox(self):
+        return (0, 0, 800, 600)
+
+def commit_list(pool):
+    # A CommitList that shows the whole history, scrolled to view_y
+    cl = CommitList.CommitList.__new__(CommitList.CommitList)
+    cl.repo = True
+    cl.commits = pool.commits
+    cl.commitPool = pool
+    cl.loadedCount = len(pool)
+    cl.loader = None
+    cl.layoutWorker = None
+    cl.refSnapshot = {}
+    cl.dateTexts = {}
+    cl.paintResources = None
+    cl.relativeDates = True
+    cl.authorColumnPos = 200
+    cl.allowMultiple = True
+
+    layout = graphlayout.GraphLayout(pool.commits)
+    layout.layout(len(pool))
+    cl.graph = layout.snapshot()
+
+    cl.view_y = 0
+    cl.GetClientSize = lambda: Size()
+    cl.GetUpdateRegion = lambda: Region()
+    cl.CalcUnscrolledPosition = lambda x, y: (x, y + cl.view_y)
+    cl.CalcScrolledPosition = lambda x, y: (x, y - cl.view_y)
+    return cl
+
+def main(args):
+    if len(args) > 1:
+        print 'Usage: commitlist_paint.py [ROWS]'
+        return 2
+    rows = len(args) and int(args[0]) or 500000
+
+    pool = git.CommitPool(None, history(rows))
+    cl = commit_list(pool)
+
+    # Like a shift-click from the last row to the first one
+    cl._SetSelection(range(rows-1, -1, -1))
+
+    for row in [0, rows/2, max(0, rows-50)]:
+        cl.view_y = row * CommitList.LINH
+        cl.OnPaint(NoOp())
+
+        start = time.time()
+        for i in xrange(PAINTS):
+            cl.OnPaint(NoOp())
+        elapsed = (time.time() - start) / PAINTS
+
+        print '%d rows, scrolled to row %d: %.2f ms per paint' % (rows, row, elapsed * 1000)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
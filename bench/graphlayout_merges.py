@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Lays out a synthetic history with long-range merges and prints the time
+# it took. A mainline of LENGTH commits gets a side branch every EVERY
+# commits: it forks SPAN commits back, has SIDE commits and is merged into
+# the mainline. The signature identifies the layout, it must not change
+# when only the speed of the layout changes.
+#
+# Usage: graphlayout_merges.py [LENGTH EVERY SPAN SIDE]
+#
+#   graphlayout_merges.py 20000 10 2000 3
+#   graphlayout_merges.py 40000 50 5000 3
+#   graphlayout_merges.py 30000 4 1000 3
+
+import sys
+import time
+import hashlib
+from os.path import realpath, dirname, join
+
+sys.path.insert(0, join(dirname(realpath(__file__)), '..', 'stupidgit_gui'))
+import git
+import graphlayout
+
+def long_merges(length, every, span, side):
+    # Records of the history in topological order (children first)
+    parents = {}
+    main = [ 'm%07d' % i for i in xrange(length) ]
+    for i in xrange(length):
+        if i+1 < length:
+            parents[main[i]] = [main[i+1]]
+        else:
+            parents[main[i]] = []
+
+    for i in xrange(0, length - span - 1, every):
+        prev = main[i + span]
+        for k in xrange(side):
+            sha1 = 's%07d_%d' % (i, k)
+            parents[sha1] = [prev]
+            prev = sha1
+        parents[main[i]].append(prev)
+
+    # Depth first, like git log --topo-order
+    children = dict([ (c, 0) for c in parents ])
+    for c, ps in parents.iteritems():
+        for p in ps:
+            children[p] += 1
+
+    order = []
+    stack = [main[0]]
+    while stack:
+        c = stack.pop()
+        order.append(c)
+        ps = list(parents[c])
+        ps.reverse()
+        for p in ps:
+            children[p] -= 1
+            if children[p] == 0:
+                stack.append(p)
+
+    return [ (c, parents[c], 'a', 0, 0, 's') for c in order ]
+
+def signature(graph):
+    sig = hashlib.md5()
+    for node in graph.rows_in(0, len(graph)):
+        sig.update('%d,%d|' % (node.x, node.color))
+    # Edges come from a set: they are hashed in the order of their rows
+    edges = [ (edge.src.y, edge.dst.y, edge.x, edge.style, edge.color)
+              for edge in graph.edges_in_rows(0, len(graph)) ]
+    edges.sort()
+    for edge in edges:
+        sig.update('%d:%d:%d:%d:%d|' % edge)
+    return sig.hexdigest()
+
+def main(args):
+    if len(args) == 4:
+        length, every, span, side = [ int(a) for a in args ]
+    elif not args:
+        length, every, span, side = 20000, 10, 2000, 3
+    else:
+        print 'Usage: graphlayout_merges.py [LENGTH EVERY SPAN SIDE]'
+        return 2
+
+    pool = git.CommitPool(None, long_merges(length, every, span, side))
+    layout = graphlayout.GraphLayout(pool.commits)
+
+    start = time.time()
+    layout.layout(len(pool))
+    elapsed = time.time() - start
+
+    graph = layout.snapshot()
+    print '%d rows, %d columns, %.2fs, signature %s' % (len(graph), graph.columns+1, elapsed, signature(graph))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,6 +1,9 @@
 import wx
 import git
+import time
+import threading
 import platformspec
+from graphlayout import *
 from util import *
 
 COLW  = 12 # Column width
@@ -23,6 +26,61 @@ EDGE_COLORS = [
     (  0,  96, 160, 200)
 ]
 
+# The graph is laid out in a background thread in blocks of BLOCK_ROWS
+# rows. Rows up to this far below the visible rows are laid out at full
+# speed, then the layout slows down to let the user interface run.
+LAYOUT_AHEAD = 64
+LAYOUT_IDLE_WAIT = 0.01
+
+# Commits that are loaded ahead of the visible rows. Beyond that the
+# loader slows down to let the user interface run.
+HISTORY_PREFETCH = 5000
+HISTORY_IDLE_WAIT = 0.02
+
+# Formatted dates of the painted rows are kept this long (in seconds):
+# relative dates change as time goes by, the list is repainted then
+DATE_TEXT_LIFETIME = 60
+
+class PaintResources(object):
+    # Pens, brushes, fonts and colours of the commit list. They are created
+    # once and dropped when the system colours or the display change.
+    def __init__(self):
+        self.commit_pen = wx.Pen(wx.Colour(0,0,0,255), width=2)
+        self.commit_brush = wx.Brush(wx.Colour(255,255,255,255))
+        self.commit_font = platformspec.Font(12)
+
+        self.commit_textcolor_normal = wx.SystemSettings_GetColour(wx.SYS_COLOUR_WINDOWTEXT)
+        self.commit_textcolor_highlight = wx.SystemSettings_GetColour(wx.SYS_COLOUR_HIGHLIGHTTEXT)
+
+        self.edge_pens = [ wx.Pen(wx.Colour(*c), width=2) for c in EDGE_COLORS ]
+
+        self.background_pen = wx.NullPen
+        self.background_brush = wx.Brush(wx.SystemSettings_GetColour(wx.SYS_COLOUR_WINDOW))
+
+        self.selection_pen = wx.NullPen
+        self.selection_brush = wx.Brush(wx.SystemSettings_GetColour(wx.SYS_COLOUR_HIGHLIGHT))
+
+        self.separator_pen = wx.Pen(wx.SystemSettings_GetColour(wx.SYS_COLOUR_3DLIGHT), width=1)
+
+        self.ref_pens = [
+            wx.Pen(wx.Colour(128,128,192,255), width=1),   # REF_BRANCH
+            wx.Pen(wx.Colour(0,255,0,255), width=1),       # REF_REMOTE
+            wx.Pen(wx.Colour(128,128,0,255), width=1),     # REF_TAG
+            wx.Pen(wx.Colour(255,128,128,255), width=1),   # REF_HEADBRANCH
+            wx.Pen(wx.Colour(255,0,0,255), width=1),       # REF_DETACHEDHEAD
+            wx.Pen(wx.Colour(160,160,160,255), width=1)    # REF_MODULE
+        ]
+        self.ref_brushes = [
+            wx.Brush(wx.Colour(160,160,255,255)), # REF_BRANCH
+            wx.Brush(wx.Colour(128,255,128,255)), # REF_REMOTE
+            wx.Brush(wx.Colour(255,255,128,255)), # REF_TAG
+            wx.Brush(wx.Colour(255,160,160,255)), # REF_HEADBRANCH
+            wx.Brush(wx.Colour(255,128,128,255)), # REF_DETACHEDHEAD
+            wx.Brush(wx.Colour(192,192,192,255))  # REF_MODULE
+        ]
+        self.ref_font = platformspec.Font(9)
+        self.ref_textcolor = wx.Colour(0,0,0,255)
+
 class CommitList(wx.ScrolledWindow):
     def __init__(self, parent, id, allowMultiple=False):
         wx.ScrolledWindow.__init__(self, parent, -1, style=wx.SUNKEN_BORDER)
@@ -34,13 +92,30 @@ class CommitList(wx.ScrolledWindow):
         self.Bind(wx.EVT_KEY_DOWN, self.OnKeyPressed)
         self.Bind(wx.EVT_MOTION, self.OnMouseMove)
         self.Bind(wx.EVT_LEAVE_WINDOW, self.OnMouseLeave)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.OnDestroy)
+        self.Bind(wx.EVT_SYS_COLOUR_CHANGED, self.OnSystemChanged)
+        self.Bind(wx.EVT_DISPLAY_CHANGED, self.OnSystemChanged)
+        self.dateTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnDateTimer, self.dateTimer)
         self.repo = None
-        self.rows = []
-        self.selection = []
+        self.refSnapshot = None
+        self.commits = []
+        self.commitPool = None
+        self.loader = None
+        self.loadedCount = 0
+        self.selectVersions = False
+        self.layoutWorker = None
+        self.graph = GraphLayout([]).snapshot()
+        self.selection = [] # selected rows, the current row first
+        self.selectedRows = set()
         self.mainRepo = None
         self.mainRepoSelection = []
         self.allowMultiple = allowMultiple
         self.authorColumnPos = 200
+        self.relativeDates = True
+        self.dateTexts = {} # row => formatted date
+        self.dateTimer.Start(DATE_TEXT_LIFETIME * 1000)
+        self.paintResources = None
         
         self.normalCursor = wx.NullCursor
         self.resizeCursor = wx.StockCursor(wx.CURSOR_SIZEWE)
@@ -51,155 +126,273 @@ class CommitList(wx.ScrolledWindow):
         # Save selection if the last repo was the main repo
         if self.repo and self.repo == self.mainRepo:
             self.mainRepo = self.repo
-            self.mainRepoSelection = [ self.rows[row][0].commit.sha1 for row in self.selection ]
+            self.mainRepoSelection = [ self.commits[row].sha1 for row in self.selection ]
 
         # Clear selection, scroll to top
         repo_changed = (self.repo != repo)
         if repo_changed:
-            self.selection = []
+            self._SetSelection([])
             self.Scroll(0, 0)
 
         # Save main repo
         if not repo.parent:
             self.mainRepo = repo
 
-        # Load commits
+        # If only references were added or removed, update the labels of
+        # the affected commits instead of reloading the whole history. A
+        # history that has not been shown yet is loaded again.
+        if not repo_changed and self.commitPool and len(self.graph) > 0:
+            changes = git.RefChanges(self.refSnapshot, repo.ref_snapshot)
+            self.refSnapshot = repo.ref_snapshot
+
+            if not changes or self._CanUpdateReferences(changes):
+                self._UpdateReferences(changes)
+                self.Refresh()
+                return
+
+        # Load commits in the background, they are shown page by page
+        # as they arrive (see OnHistoryPage). The graph of the old history
+        # is not laid out any further.
         self.repo = repo
-        self.commits = self.repo.get_log(['--topo-order', '--all'])
-        self.CreateLogGraph()
+        self.refSnapshot = repo.ref_snapshot
+        if self.layoutWorker:
+            self.layoutWorker.Cancel()
+        if repo_changed:
+            self.commits = []
+            self.commitPool = None
+            self.loadedCount = 0
+            self.layoutWorker = None
+            self.graph = GraphLayout([]).snapshot()
 
         # If this is a submodule, select versions that are referenced
-        # by the parent module
-        if repo_changed and self.repo != self.mainRepo:
-            for version in self.mainRepoSelection:
-                submodule_version = self.repo.parent.get_submodule_version(self.repo.name, version)
-                if submodule_version:
-                    rows = [ r for r in self.rows if r[0].commit.sha1 == submodule_version ]
-                    if rows:
-                        self.selection.append(self.rows.index(rows[0]))
+        # by the parent module when they have been loaded
+        self.selectVersions = repo_changed and self.repo != self.mainRepo
+
+        if self.loader:
+            self.loader.Cancel()
+        self.loader = HistoryLoader(self, repo)
+        self.loader.start()
 
         # Setup UI
-        self.SetVirtualSize((-1, (len(self.rows)+1) * LINH))
+        self._UpdateVirtualSize()
         self.SetScrollRate(LINH, LINH)
         self.Refresh()
-    
-    def CreateLogGraph(self):
-        rows = []  # items: (node, edges)
-        nodes = {} # commit => GraphNode
-        lanes = []
-        color = 0
-
-        self.rows = rows
-        self.columns = 0
-        self.nodes = nodes
-        
-        for y in xrange(len(self.commits)):
-            # 1. Create node
-            commit = self.commits[y]
-            node = GraphNode(commit)
-            nodes[commit] = node
-            node.y = y
-            rows.append((node, []))
-
-            # 2. Determine column
-            x = None
-
-            # 2.1. search for a commit in lanes whose parent is c
-            for i in xrange(len(lanes)):
-                if lanes[i] and commit in lanes[i].commit.parents:
-                    x = i
-                    node.color = lanes[i].color
-                    break
 
-            # 2.2. if there is no such commit, put to the first empty place
-            if x == None:
-                node.color = color
-                color += 1
-                if None in lanes:
-                    x = lanes.index(None)
-                else:
-                    x = len(lanes)
-                    lanes.append(None)
-
-            node.x = x
-            self.columns = max(self.columns, x)
-
-            # 3. Create edges
-            for child_commit in commit.children:
-                child = nodes[child_commit]
-                edge = GraphEdge(node, child)
-                node.child_edges.append(edge)
-                child.parent_edges.append(edge)
-
-                # 3.1. Determine edge style
-                if child.x == node.x and lanes[x] == child:
-                    edge.style = EDGE_DIRECT
-                    edge.x = node.x
-                    edge.color = child.color
-                elif len(child_commit.parents) == 1:
-                    edge.style = EDGE_BRANCH
-                    edge.x = child.x
-                    edge.color = child.color
-                else:
-                    edge.style = EDGE_MERGE
-                    edge.color = node.color
-
-                    # Determine column for merge edges
-                    edge.x = max(node.x, child.x+1)
-                    success = False
-                    while not success:
-                        success = True
-                        for yy in xrange(node.y, child.y, -1):
-                            n, edges = rows[yy]
-                            if (yy < node.y and n.x == edge.x) or (len(edges) > edge.x and edges[edge.x] != None):
-                                edge.x += 1
-                                success = False
-                                break
-
-                # 3.2. Register edge in rows
-                for yy in xrange(node.y, child.y, -1):
-                    n, edges = rows[yy]
-                    if len(edges) < edge.x+1:
-                        edges += [None] * (edge.x+1 - len(edges))
-                    edges[edge.x] = edge
-
-                self.columns = max(self.columns, edge.x)
-
-            # 4. End those lanes whose parents are already drawn
-            for i in xrange(len(lanes)):
-                if lanes[i] and len(lanes[i].parent_edges) == len(lanes[i].commit.parents):
-                    lanes[i] = None
-
-            lanes[x] = node
-
-        # References
-        if self.repo.current_branch:
-            self._add_reference(self.repo.head, self.repo.current_branch, REF_HEADBRANCH)
+    def OnHistoryPage(self, loader, pool, count, finished):
+        if loader != self.loader:
+            return
+
+        # A new history replaces the old one on its first page. Usually
+        # only a few commits have been added or removed at the top: the
+        # rest of the old layout is reused. The layout is also continued
+        # if SetRepo stopped it but the history did not change.
+        if pool != self.commitPool:
+            self.commitPool = pool
+            self.commits = pool.commits
+            self.loadedCount = 0
+            self._StartLayout(self.layoutWorker)
+        elif self.layoutWorker.cancelled:
+            self._StartLayout(self.layoutWorker)
+
+        self.loadedCount = count
+
+        if finished:
+            self.loader = None
+
+            # Parents that never arrived do not keep lanes open
+            if pool.missing_parents:
+                self._StartLayout(None)
+
+            if self.selectVersions:
+                self.selectVersions = False
+                self._SelectSubmoduleVersions()
+
+        self.layoutWorker.Extend(count, finished)
+        self._UpdateVirtualSize()
+        self.Refresh()
+
+    def OnHistoryError(self, loader, msg):
+        if loader != self.loader:
+            return
+
+        self.loader = None
+        self._UpdateVirtualSize()
+        self.Refresh()
+        wx.MessageBox(safe_unicode(msg), 'Error', style=wx.OK|wx.ICON_ERROR)
+
+    def OnLayoutProgress(self, worker, graph, first):
+        if worker != self.layoutWorker:
+            return
+
+        old_graph = self.graph
+        self._SetGraph(graph, first)
+
+        # Edges of the new rows may reach up to the visible rows
+        start_col, start_row = self.GetViewStart()
+        end_row = start_row + self.GetClientSize().GetHeight() / LINH + 1
+        if (graph.edges is not old_graph.edges or first <= end_row or
+            [ edge for edge in graph.edges[old_graph.edge_count:graph.edge_count] if edge.dst.y < end_row ]):
+            self.Refresh()
+
+    def OnDestroy(self, e):
+        e.Skip()
+        self.dateTimer.Stop()
+        if self.loader:
+            self.loader.Cancel()
+            self.loader = None
+        if self.layoutWorker:
+            self.layoutWorker.Cancel()
+            self.layoutWorker = None
+
+    def OnDateTimer(self, e):
+        # Relative dates of the shown rows are formatted again
+        self.dateTexts = {}
+        self.Refresh()
+
+    def SetRelativeDates(self, relativeDates):
+        # Shows dates like "2 hours ago" or as absolute dates
+        self.relativeDates = relativeDates
+        self.dateTexts = {}
+        if relativeDates:
+            self.dateTimer.Start(DATE_TEXT_LIFETIME * 1000)
         else:
-            self._add_reference(self.repo.head, 'DETACHED HEAD', REF_DETACHEDHEAD)
-
-        if self.repo.main_ref:
-            self._add_reference(self.repo.main_ref, 'MAIN/HEAD', REF_MODULE)
-        if self.repo.main_merge_ref:
-            self._add_reference(self.repo.main_merge_ref, 'MAIN/MERGE_HEAD', REF_MODULE)
-
-        for branch,commit_id in self.repo.branches.iteritems():
-            if branch != self.repo.current_branch:
-                self._add_reference(commit_id, branch, REF_BRANCH)
-        for branch,commit_id in self.repo.remote_branches.iteritems():
-            self._add_reference(commit_id, branch, REF_REMOTE)
-        for tag,commit_id in self.repo.tags.iteritems():
-            self._add_reference(commit_id, tag, REF_TAG)
-
-    def _add_reference(self, commit_id, refname, reftype):
-        if commit_id not in git.commit_pool:
+            self.dateTimer.Stop()
+        self.Refresh()
+
+    def OnSystemChanged(self, e):
+        e.Skip()
+        platformspec.reset()
+        self.paintResources = None
+        self.Refresh()
+
+    def _UpdateVirtualSize(self):
+        # An extra row is shown while loading for the progress message
+        rows = self.loadedCount
+        if self.loader:
+            rows += 1
+        self.SetVirtualSize((-1, (rows+1) * LINH))
+
+    def _SelectSubmoduleVersions(self):
+        modules = []
+        module = self.repo
+        while module.parent:
+            modules.insert(0, module)
+            module = module.parent
+
+        for version in self.mainRepoSelection:
+            # Follow the versions through nested submodules
+            submodule_version = version
+            for module in modules:
+                submodule_version = module.parent.get_submodule_version(module.name, submodule_version)
+                if not submodule_version:
+                    break
+
+            # Rows are in the same order as the commits of the pool
+            if submodule_version in self.commitPool:
+                row = self.commitPool.indexes[submodule_version]
+                self.selection.append(row)
+                self.selectedRows.add(row)
+
+    def _StartLayout(self, previous):
+        # Lays out the graph of self.commits in the background (see
+        # OnLayoutProgress). The layout of the previous worker is reused
+        # where the histories are the same.
+        if self.layoutWorker:
+            self.layoutWorker.Cancel()
+        self.layoutWorker = LayoutWorker(self, self.commits, previous)
+        self.layoutWorker.start()
+        self.refTargets = self._ReferencedCommits(self.refSnapshot.itervalues())
+
+    def _SetGraph(self, graph, first):
+        # Shows a snapshot of the layout, rows from first on are new
+        if graph.rows is not self.graph.rows:
+            self.dateTexts = {}
+        self.graph = graph
+
+        # Rows that come from an earlier layout may have old labels
+        for node in graph.rows_in(first, len(graph)):
+            if node.commit.sha1 in self.refTargets:
+                self._SetReferences(node.commit.sha1)
+            elif node.references:
+                node.references = []
+
+    def _ReferencedCommits(self, values):
+        # Commit ids in ref snapshot values (HEAD is stored with the branch name)
+        commit_ids = set()
+        for value in values:
+            if type(value) == tuple:
+                value = value[0]
+            if value:
+                commit_ids.add(value)
+        return commit_ids
+
+    def _CanUpdateReferences(self, changes):
+        # New references must point to commits that are already shown
+        # (MAIN/* refs are only labels, they do not add commits to the history)
+        new_values = changes.added.items() + [ (ref, new) for ref, (old, new) in changes.moved.iteritems() ]
+        new_values = [ value for ref, value in new_values if not ref.startswith('MAIN/') ]
+        for commit_id in self._ReferencedCommits(new_values):
+            if commit_id not in self.commitPool or self.commitPool.indexes[commit_id] >= len(self.graph):
+                return False
+
+        # Commits that lost a reference must still be referenced by something
+        # else, otherwise they may have disappeared from the history
+        current_commits = self._ReferencedCommits(self.refSnapshot.itervalues())
+        old_values = changes.deleted.items() + [ (ref, old) for ref, (old, new) in changes.moved.iteritems() ]
+        old_values = [ value for ref, value in old_values if not ref.startswith('MAIN/') ]
+        for commit_id in self._ReferencedCommits(old_values):
+            if commit_id not in current_commits:
+                return False
+
+        return True
+
+    def _UpdateReferences(self, changes):
+        self.refTargets = self._ReferencedCommits(self.refSnapshot.itervalues())
+
+        values = changes.added.values() + changes.deleted.values()
+        for old, new in changes.moved.itervalues():
+            values += [old, new]
+
+        for commit_id in self._ReferencedCommits(values):
+            self._SetReferences(commit_id)
+
+    def _SetReferences(self, commit_id):
+        # Rows are in the same order as the commits of the pool
+        if commit_id not in self.commitPool:
             return
 
-        commit = git.commit_pool[commit_id]
-        if commit not in self.nodes:
+        row = self.commitPool.indexes[commit_id]
+        if row >= len(self.graph):
             return
 
-        self.nodes[commit].references.append((refname, reftype))
+        repo = self.repo
+        references = []
+
+        if commit_id == repo.head:
+            if repo.current_branch:
+                references.append((repo.current_branch, REF_HEADBRANCH))
+            else:
+                references.append(('DETACHED HEAD', REF_DETACHEDHEAD))
+
+        if commit_id == repo.main_ref:
+            references.append(('MAIN/HEAD', REF_MODULE))
+        if commit_id == repo.main_merge_ref:
+            references.append(('MAIN/MERGE_HEAD', REF_MODULE))
+
+        for branch in repo.branches_by_sha1.get(commit_id, []):
+            if branch != repo.current_branch:
+                references.append((branch, REF_BRANCH))
+        for branch in repo.remote_branches_by_sha1.get(commit_id, []):
+            references.append((branch, REF_REMOTE))
+        for tag in repo.tags_by_sha1.get(commit_id, []):
+            references.append((tag, REF_TAG))
+
+        self.graph[row].references = references
+
+    def _GetPaintResources(self):
+        if not self.paintResources:
+            self.paintResources = PaintResources()
+        return self.paintResources
 
     def OnPaint(self, evt):
         evt.Skip(False)
@@ -225,48 +418,31 @@ class CommitList(wx.ScrolledWindow):
         start_x, start_y = self.CalcUnscrolledPosition(x, y)
         start_row, end_row = max(0, start_y/LINH-1), (start_y+height)/LINH+1
 
-        # Setup pens, brushes and fonts
-        commit_pen = wx.Pen(wx.Colour(0,0,0,255), width=2)
-        commit_brush = wx.Brush(wx.Colour(255,255,255,255))
-        commit_font = platformspec.Font(12)
-
-        commit_textcolor_normal = wx.SystemSettings_GetColour(wx.SYS_COLOUR_WINDOWTEXT)
-        commit_textcolor_highlight = wx.SystemSettings_GetColour(wx.SYS_COLOUR_HIGHLIGHTTEXT)
-
-        edge_pens = [ wx.Pen(wx.Colour(*c), width=2) for c in EDGE_COLORS ]
-
-        background_pen = wx.NullPen
-        background_brush = wx.Brush(wx.SystemSettings_GetColour(wx.SYS_COLOUR_WINDOW))
+        # The loader and the layout are told how far the user has scrolled
+        if self.loader:
+            self.loader.Request(end_row+1)
+        if self.layoutWorker:
+            self.layoutWorker.Request(end_row+2 + LAYOUT_AHEAD)
+        graph = self.graph
 
-        selection_pen = wx.NullPen
-        selection_brush = wx.Brush(wx.SystemSettings_GetColour(wx.SYS_COLOUR_HIGHLIGHT))
-        
-        separator_pen = wx.Pen(wx.SystemSettings_GetColour(wx.SYS_COLOUR_3DLIGHT), width=1)
-
-        ref_pens = [
-            wx.Pen(wx.Colour(128,128,192,255), width=1),   # REF_BRANCH
-            wx.Pen(wx.Colour(0,255,0,255), width=1),       # REF_REMOTE
-            wx.Pen(wx.Colour(128,128,0,255), width=1),     # REF_TAG
-            wx.Pen(wx.Colour(255,128,128,255), width=1),   # REF_HEADBRANCH
-            wx.Pen(wx.Colour(255,0,0,255), width=1),       # REF_DETACHEDHEAD
-            wx.Pen(wx.Colour(160,160,160,255), width=1)    # REF_MODULE
-        ]
-        ref_brushes = [
-            wx.Brush(wx.Colour(160,160,255,255)), # REF_BRANCH
-            wx.Brush(wx.Colour(128,255,128,255)), # REF_REMOTE
-            wx.Brush(wx.Colour(255,255,128,255)), # REF_TAG
-            wx.Brush(wx.Colour(255,160,160,255)), # REF_HEADBRANCH
-            wx.Brush(wx.Colour(255,128,128,255)), # REF_DETACHEDHEAD
-            wx.Brush(wx.Colour(192,192,192,255))  # REF_MODULE
-        ]
-        ref_font = platformspec.Font(9)
-        ref_textcolor = wx.Colour(0,0,0,255)
+        # Setup pens, brushes and fonts
+        res = self._GetPaintResources()
+        commit_pen, commit_brush, commit_font = res.commit_pen, res.commit_brush, res.commit_font
+        commit_textcolor_normal = res.commit_textcolor_normal
+        commit_textcolor_highlight = res.commit_textcolor_highlight
+        edge_pens = res.edge_pens
+        background_pen, background_brush = res.background_pen, res.background_brush
+        selection_pen, selection_brush = res.selection_pen, res.selection_brush
+        separator_pen = res.separator_pen
+        ref_pens, ref_brushes = res.ref_pens, res.ref_brushes
+        ref_font, ref_textcolor = res.ref_font, res.ref_textcolor
 
         # Draw selection
         dc.SetPen(selection_pen)
         dc.SetBrush(selection_brush)
-        for row in self.selection:
-            if start_row <= row <= end_row:
+        selected_rows = self.selectedRows
+        for row in xrange(start_row, end_row+1):
+            if row in selected_rows:
                 x, y = self.CalcScrolledPosition(0, (row+1)*LINH)
                 dc.DrawRectangle(0, y-LINH/2, clientWidth, LINH)
 
@@ -275,12 +451,7 @@ class CommitList(wx.ScrolledWindow):
         offy = LINH
 
         # Draw edges
-        edges = set()
-        for node,row_edges in self.rows[start_row:end_row+1]:
-            edges.update(row_edges)
-        for edge in edges:
-            if not edge: continue
-
+        for edge in graph.edges_in_rows(start_row, end_row):
             dc.SetPen(edge_pens[edge.color % len(EDGE_COLORS)])
             if edge.style == EDGE_DIRECT:
                 x1, y1 = self.CalcScrolledPosition( edge.src.x*COLW+offx, edge.src.y*LINH+offy )
@@ -304,9 +475,9 @@ class CommitList(wx.ScrolledWindow):
         # Draw commits
         dc.SetPen(commit_pen)
         dc.SetBrush(commit_brush)
-        for node,edges in self.rows[start_row:end_row+1]:
+        for node in graph.rows_in(start_row, end_row+1):
             # Background pen & brush
-            if self.rows.index((node, edges)) in self.selection:
+            if node.y in selected_rows:
                 commit_bg_pen = selection_pen
                 commit_bg_brush = selection_brush
             else:
@@ -326,10 +497,11 @@ class CommitList(wx.ScrolledWindow):
                 dc.DrawCircle(xx, yy, COMW/2)
 
             # Calculate column
-            if node.y < len(self.rows)-1:
-                text_column = max(len(edges), len(self.rows[node.y+1][1]))
+            width = graph.row_width(node.y)
+            if node.y < len(graph)-1:
+                text_column = max(width, graph.row_width(node.y+1))
             else:
-                text_column = len(edges) if len(edges) > 0 else 1
+                text_column = width if width > 0 else 1
 
             # Draw references
             msg_offset = 0
@@ -374,7 +546,7 @@ class CommitList(wx.ScrolledWindow):
             y = node.y*LINH + offy - LINH/2
             xx, yy = self.CalcScrolledPosition(x, y)
             
-            if self.rows.index((node, edges)) in self.selection:
+            if node.y in selected_rows:
                 dc.SetTextForeground(commit_textcolor_highlight)
             else:
                 dc.SetTextForeground(commit_textcolor_normal)
@@ -395,9 +567,29 @@ class CommitList(wx.ScrolledWindow):
             
             dc.SetPen(commit_pen)
             dc.SetBrush(commit_brush)
-            author_text = u'%s, %s' % (safe_unicode(node.commit.author_name), safe_unicode(node.commit.author_date))
+
+            # Dates are formatted only for painted rows
+            date_text = self.dateTexts.get(node.y)
+            if date_text == None:
+                if self.relativeDates:
+                    date_text = node.commit.author_date
+                else:
+                    date_text = node.commit.author_date_absolute
+                self.dateTexts[node.y] = date_text
+
+            author_text = u'%s, %s' % (safe_unicode(node.commit.author_name), safe_unicode(date_text))
             dc.DrawText(author_text, xx+4, yy)
 
+        # Draw progress
+        dc.SetFont(commit_font)
+        dc.SetTextForeground(commit_textcolor_normal)
+        if len(graph) < self.loadedCount and start_row <= len(graph) <= end_row:
+            xx, yy = self.CalcScrolledPosition(offx, len(graph)*LINH + offy - LINH/2)
+            dc.DrawText(u'Drawing graph... (%d of %d commits)' % (len(graph), self.loadedCount), xx, yy)
+        if self.loader and start_row <= self.loadedCount <= end_row:
+            xx, yy = self.CalcScrolledPosition(offx, self.loadedCount*LINH + offy - LINH/2)
+            dc.DrawText(u'Loading history... (%d commits)' % self.loadedCount, xx, yy)
+
         dc.EndDrawing()
 
     def OnMouseMove(self, e):
@@ -431,20 +623,19 @@ class CommitList(wx.ScrolledWindow):
             return
 
         # Handle different type of clicks
-        old_selection = list(self.selection)
-        if self.allowMultiple and e.ShiftDown() and len(old_selection) >= 1:
-            from_row = old_selection[0]
+        if self.allowMultiple and e.ShiftDown() and self.selection:
+            from_row = self.selection[0]
             to_row = row
             if to_row >= from_row:
-                self.selection = range(from_row, to_row+1)
+                self._SetSelection(range(from_row, to_row+1))
             else:
-                self.selection = range(to_row, from_row+1)
-                self.selection.reverse()
+                self._SetSelection(range(from_row, to_row-1, -1))
         elif self.allowMultiple and (e.ControlDown() or e.CmdDown()):
-            if row not in self.selection:
+            if row not in self.selectedRows:
                 self.selection.insert(0, row)
+                self.selectedRows.add(row)
         else:
-            self.selection = [row]
+            self._SetSelection([row])
 
         # Emit click event
         event = CommitListEvent(EVT_COMMITLIST_SELECT_type, self.GetId())
@@ -488,7 +679,7 @@ class CommitList(wx.ScrolledWindow):
         key = e.GetKeyCode()
 
         # Handle only UP and DOWN keys
-        if key not in [wx.WXK_UP, wx.WXK_DOWN] or len(self.rows) == 0:
+        if key not in [wx.WXK_UP, wx.WXK_DOWN] or self.loadedCount == 0:
             e.Skip()
             return
 
@@ -506,24 +697,26 @@ class CommitList(wx.ScrolledWindow):
             if key == wx.WXK_UP:
                 next_row = max(current_row-1, 0)
             if key == wx.WXK_DOWN:
-                next_row = min(current_row+1, len(self.rows)-1)
+                next_row = min(current_row+1, self.loadedCount-1)
 
             # Process modifiers
             if e.ShiftDown() and self.allowMultiple:
-                if next_row in self.selection:
+                if next_row in self.selectedRows:
                     self.selection.remove(current_row)
+                    self.selectedRows.discard(current_row)
                 else:
                     self.selection.insert(0, next_row)
+                    self.selectedRows.add(next_row)
             else:
-                self.selection = [next_row]
+                self._SetSelection([next_row])
 
         else:
             # Select topmost row of current view
             next_row = start_row
-            if next_row < 0 or next_row > len(self.rows):
+            if next_row < 0 or next_row >= self.loadedCount:
                 return
 
-            self.selection = [next_row]
+            self._SetSelection([next_row])
 
         # Scroll selection if necessary
         if next_row < start_row:
@@ -540,29 +733,49 @@ class CommitList(wx.ScrolledWindow):
 
         self.Refresh()
 
+    def _SetSelection(self, rows):
+        # The painted rows are looked up in selectedRows, the order of the
+        # selection is kept for the selection events
+        self.selection = rows
+        self.selectedRows = set(rows)
+
     def RowNumberByCoords(self, x, y):
         row = (y+LINH/2) / LINH - 1
 
-        if row < 0 or row >= len(self.rows):
+        if row < 0 or row >= self.loadedCount:
             return None
         else:
             return row
 
     def CommitByRow(self, row):
-        return self.rows[row][0].commit
+        # The shown row, the layout of a new history may not have reached it
+        if row < len(self.graph):
+            return self.graph[row].commit
+        return self.commits[row]
 
     def GotoCommit(self, commit_id):
-        matching_commits = [c for c in self.commits if c.sha1.startswith(commit_id)]
-        if len(matching_commits) == 0:
+        # Rows are in the same order as the commits of the pool. The rows
+        # up to the commit are laid out when they are painted.
+        pool = self.commitPool
+        if not pool:
             return "Commit id '%s' cannot be found" % commit_id
-        elif len(matching_commits) > 1:
+
+        row = pool.indexes.get(commit_id)
+        if row != None and row < self.loadedCount:
+            matching_rows = [row]
+        else:
+            matching_rows = [ i for i in xrange(self.loadedCount) if pool.sha1s[i].startswith(commit_id) ]
+
+        if len(matching_rows) == 0:
+            return "Commit id '%s' cannot be found" % commit_id
+        elif len(matching_rows) > 1:
             return "Given commit ID (%s) is ambiguous" % commit_id
         else:
-            self.SelectRow(self.commits.index(matching_commits[0]))
+            self.SelectRow(matching_rows[0])
             return None
 
     def SelectRow(self, row):
-        self.selection = [row]
+        self._SetSelection([row])
         
         # Emit selection event
         event = CommitListEvent(EVT_COMMITLIST_SELECT_type, self.GetId())
@@ -588,6 +801,124 @@ class CommitList(wx.ScrolledWindow):
     def OnRightButtonClicked(self, row, selection):
         pass
 
+class HistoryLoader(threading.Thread):
+    # Loads the history of a repository in a background thread and passes
+    # every page of commits to the commit list in the UI thread
+    def __init__(self, commitList, repo):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+        self.commitList = commitList
+        self.repo = repo
+        self.cancelled = False
+        self.wanted = 0
+        self.demand = threading.Event()
+
+    def Cancel(self):
+        self.cancelled = True
+        self.demand.set()
+
+    def Request(self, rows):
+        # The commit list needs this many rows right now
+        if rows > self.wanted:
+            self.wanted = rows
+            self.demand.set()
+
+    def run(self):
+        try:
+            count = 0
+            for pool in self.repo.load_history():
+                if self.cancelled:
+                    return
+
+                count = len(pool)
+                wx.CallAfter(self._Deliver, self.commitList.OnHistoryPage, pool, count, False)
+
+                # Pages that are far ahead of the visible rows can wait a bit
+                if count > self.wanted + HISTORY_PREFETCH:
+                    self.demand.wait(HISTORY_IDLE_WAIT)
+                    self.demand.clear()
+
+            wx.CallAfter(self._Deliver, self.commitList.OnHistoryPage, pool, count, True)
+        except git.GitError, msg:
+            wx.CallAfter(self._Deliver, self.commitList.OnHistoryError, str(msg))
+        except Exception, e:
+            # Errors of the cache or the object database end the loading
+            # as well, the list must not wait for pages forever
+            wx.CallAfter(self._Deliver, self.commitList.OnHistoryError, "Cannot load history: %s" % e)
+
+    def _Deliver(self, handler, *args):
+        # Runs in the UI thread: the commit list may have been destroyed
+        # since the call was queued
+        if not self.cancelled:
+            handler(self, *args)
+
+class LayoutWorker(threading.Thread):
+    # Lays out the graph of a history in a background thread, block by
+    # block, as its commits are loaded. After every block a snapshot of
+    # the layout is passed to the commit list in the UI thread.
+    def __init__(self, commitList, commits, previous=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+        self.commitList = commitList
+        self.commits = commits
+        self.previous = previous
+        self.layout = None
+        self.cancelled = False
+        self.count = 0
+        self.finished = False
+        self.wanted = 0
+        self.demand = threading.Event()
+
+    def Cancel(self):
+        # The layout stops at the end of the current block
+        self.cancelled = True
+        self.demand.set()
+
+    def Extend(self, count, finished):
+        # This many commits are loaded, more come if not finished
+        self.count = count
+        self.finished = finished
+        self.demand.set()
+
+    def Request(self, rows):
+        # The commit list needs this many rows right now
+        if rows > self.wanted:
+            self.wanted = rows
+            self.demand.set()
+
+    def run(self):
+        # The previous layout can be used when its worker has stopped
+        previous = None
+        if self.previous:
+            self.previous.join()
+            previous = self.previous.layout
+            self.previous = None
+
+        layout = self.layout = GraphLayout(self.commits, previous)
+        while not self.cancelled:
+            # Extend sets the count before finished
+            finished = self.finished
+            rows = len(layout.rows)
+            if rows < self.count:
+                first = layout.layout(min((rows / BLOCK_ROWS + 1) * BLOCK_ROWS, self.count))
+                wx.CallAfter(self._Deliver, self.commitList.OnLayoutProgress, layout.snapshot(), first)
+
+                # Blocks that are far below the visible rows can wait a bit
+                if len(layout.rows) > self.wanted:
+                    self.demand.wait(LAYOUT_IDLE_WAIT)
+                    self.demand.clear()
+            elif finished:
+                return
+            else:
+                self.demand.wait()
+                self.demand.clear()
+
+    def _Deliver(self, handler, *args):
+        if not self.cancelled:
+            handler(self, *args)
+
 EVT_COMMITLIST_SELECT_type = wx.NewEventType()
 EVT_COMMITLIST_SELECT = wx.PyEventBinder(EVT_COMMITLIST_SELECT_type, 1)
 
@@ -619,47 +950,9 @@ class CommitListEvent(wx.PyCommandEvent):
     def GetCoords(self):
         return self.coords
 
-NODE_NORMAL   = 0
-NODE_BRANCH   = 1
-NODE_MERGE    = 2
-NODE_JUNCTION = 3
-
 REF_BRANCH       = 0
 REF_REMOTE       = 1
 REF_TAG          = 2
 REF_HEADBRANCH   = 3
 REF_DETACHEDHEAD = 4
 REF_MODULE       = 5
-class GraphNode(object):
-    def __init__(self, commit):
-        self.commit = commit
-        self.x = None
-        self.y = None
-        self.color = None
-
-        self.parent_edges = []
-        self.child_edges  = []
-        self.references   = []
-
-        if len(commit.parents) > 1 and len(commit.children) > 1:
-            self.style = NODE_JUNCTION
-        elif len(commit.parents) > 1:
-            self.style = NODE_MERGE
-        elif len(commit.children) > 1:
-            self.style = NODE_BRANCH
-        else:
-            self.style = NODE_NORMAL
-
-EDGE_DIRECT = 0
-EDGE_BRANCH = 1
-EDGE_MERGE  = 2
-class GraphEdge(object):
-    def __init__(self, src, dst):
-        self.src = src
-        self.dst = dst
-
-        self.style = None
-        self.color = None
-        self.x = None
-        self.color = None
-
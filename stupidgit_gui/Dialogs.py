@@ -90,8 +90,8 @@ class CommitListDialog(DiffDialog):
         rowid = e.GetIndex()
         commit = self.commits[rowid]
 
-        commit_diff = self.repo.run_cmd(['show', commit.sha1])
-        self.diffViewer.SetDiffText(commit_diff, commit_mode=True)
+        commit_diff = self.repo.run_cmd(['show', commit.sha1], stream=True)
+        self.diffViewer.SetDiffLines(commit_diff, commit_mode=True)
 
 class UncommittedFilesDialog(DiffDialog):
     def __init__(self, parent, id, repo, title='', message=''):
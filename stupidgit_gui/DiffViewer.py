@@ -55,6 +55,10 @@ class DiffViewer(wx.Panel):
         self.textCtrl.SetReadOnly(True)
 
     def SetDiffText(self, text, commit_mode=False):
+        self.SetDiffLines(text.split('\n'), commit_mode)
+
+    def SetDiffLines(self, lines, commit_mode=False):
+        # lines can be any iterable, e.g. the streamed output of git
         self.Clear()
         self.textCtrl.SetReadOnly(False)
 
@@ -71,7 +75,7 @@ class DiffViewer(wx.Panel):
         style = STYLE_NORMAL
         pos = 0
         lineno = 0
-        for line in text.split('\n'):
+        for line in lines:
             # Determine line style
             if in_commit_header:
                 if line == '':
@@ -109,7 +109,7 @@ class FetchProgressDialog(wx.Dialog):
         self.repos = [ repo ]
         self.repoIndex = 0
         if includeSubmodules:
-            self.repos += [ m for m in repo.submodules if remote in m.remotes ]
+            self.repos += [ m for m in repo.all_modules[1:] if remote in m.remotes ]
 
         # Layout
         self.SetTitle('Fetching from remote %s...' % remote)
@@ -158,7 +158,7 @@ class FetchProgressDialog(wx.Dialog):
         repo = self.repos[self.repoIndex]
 
         if self.submoduleText:
-            self.submoduleText.SetLabel('Fetching commits for %s...' % repo.name)
+            self.submoduleText.SetLabel('Fetching commits for %s...' % repo.full_name)
             self.submoduleProgress.SetValue(self.repoIndex)
 
             # Resize window if necessary
@@ -37,6 +37,7 @@ class HistoryTab(object):
         
         self.commitList = CommitList(browserPanel, -1, False)
         self.commitList.authorColumnPos = self.mainController.config.ReadInt('CommitListAuthorColumnPosition', 200)
+        self.commitList.SetRelativeDates(not self.mainController.config.ReadInt('CommitListAbsoluteDates', 0))
         self.commitList.Bind(EVT_COMMITLIST_SELECT, self.OnCommitSelected, self.commitList)
         self.commitList.Bind(EVT_COMMITLIST_RIGHTCLICK, self.OnCommitRightClick, self.commitList)
         browserSizer.Add(self.commitList, 1, wx.EXPAND)
@@ -71,7 +72,9 @@ class HistoryTab(object):
             ('cherryPickMenuItem', wx.EVT_MENU, self.OnCherryPick),
             ('revertMenuItem', wx.EVT_MENU, self.OnRevert),
             ('gotoCommitMenuItem', wx.EVT_MENU, self.OnGotoCommit),
+            ('absoluteDatesMenuItem', wx.EVT_MENU, self.OnAbsoluteDates),
         ])
+        self.mainWindow.GetMenuBar().Check(xrc.XRCID('absoluteDatesMenuItem'), not self.commitList.relativeDates)
 
     def OnCreated(self):
         self.splitter.SetSashPosition(self.mainController.config.ReadInt('HistorySplitterPosition', 200))
@@ -89,16 +92,14 @@ class HistoryTab(object):
 
         self.repo = repo
         self.commitList.SetRepo(repo)
-
-        difftext = self.repo.run_cmd(['show', 'HEAD^'])
         self.diffViewer.Clear()
 
     def OnCommitSelected(self, e):
         self.contextCommit = self.commitList.CommitByRow(e.currentRow)
 
         # Show in diff viewer
-        commit_diff = self.repo.run_cmd(['show', self.contextCommit.sha1])
-        self.diffViewer.SetDiffText(commit_diff, commit_mode=True)
+        commit_diff = self.repo.run_cmd(['show', self.contextCommit.sha1], stream=True)
+        self.diffViewer.SetDiffLines(commit_diff, commit_mode=True)
 
     def OnCommitRightClick(self, e):
         self.contextCommit = self.commitList.CommitByRow(e.currentRow)
@@ -209,7 +210,7 @@ class HistoryTab(object):
             if retcode != 0:
                 if 'CONFLICT' in stdout:
                     # Create MERGE_MSG
-                    f = open(os.path.join(self.repo.dir, '.git', 'MERGE_MSG'), 'w')
+                    f = open(os.path.join(self.repo.git_dir, 'MERGE_MSG'), 'w')
                     f.write("%s\n\nConflicts:\n" % mergeMsg)
                     unstaged, staged = self.repo.get_status()
                     unmerged_files = [ fn for fn,status in unstaged.iteritems() if status == git.FILE_UNMERGED ]
@@ -353,9 +354,13 @@ class HistoryTab(object):
                     style=wx.OK|wx.ICON_ERROR
                 )
 
+    def OnAbsoluteDates(self, e):
+        self.commitList.SetRelativeDates(not e.IsChecked())
+
     def SaveState(self):
         self.mainController.config.WriteInt('HistorySplitterPosition', self.splitter.GetSashPosition())
         self.mainController.config.WriteInt('CommitListAuthorColumnPosition', self.commitList.authorColumnPos)
+        self.mainController.config.WriteInt('CommitListAbsoluteDates', int(not self.commitList.relativeDates))
 
     def SetupContextMenu(self, commit):
         branches = self.repo.branches_by_sha1.get(commit.sha1, [])
@@ -9,6 +9,7 @@ import sys
 import MainWindow
 import Wizard
 from DiffViewer import DiffViewer
+import git
 from git import *
 from util import *
 from wxutil import *
@@ -140,6 +141,9 @@ class IndexTab(object):
             filename = self.stagedChanges[row][0]
             if self.repo.head == 'HEAD':
                 self.repo.run_cmd(['rm', '--cached', filename])
+            elif filename in self.renameSources:
+                # Unstage both sides of a rename
+                self.repo.run_cmd(['reset', 'HEAD', filename, self.renameSources[filename]])
             else:
                 self.repo.run_cmd(['reset', 'HEAD', filename])
 
@@ -219,7 +223,7 @@ class IndexTab(object):
             self.mainWindow.PopupMenu(self.unstagedMenu)
 
     def OnCommit(self, e):
-        if len(self.stagedChanges) == 0 and not os.path.exists(os.path.join(self.repo.dir, '.git', 'MERGE_HEAD')):
+        if len(self.stagedChanges) == 0 and not os.path.exists(os.path.join(self.repo.git_dir, 'MERGE_HEAD')):
             wx.MessageBox(
                 "Stage some files on Changes tab before committing!",
                 "Nothing to commit.",
@@ -265,7 +269,7 @@ class IndexTab(object):
         )
         if msg.ShowModal() == wx.ID_YES:
             try:
-                content = self.repo.run_cmd(['cat-file', 'blob', ':%d:%s' % (index, filename)], raise_error=True)
+                sha1, objtype, content = self.repo.read_object(':%d:%s' % (index, filename))
                 f = open(os.path.join(self.repo.dir, filename), 'wb')
                 f.write(content)
                 f.close()
@@ -297,7 +301,9 @@ class IndexTab(object):
 
     def SetRepo(self, repo):
         self.repo = repo
-        unstagedDict, stagedDict = self.repo.get_status()
+        status = self.repo.get_full_status()
+        unstagedDict, stagedDict = status.unstaged, status.staged
+        self.renameSources = status.rename_sources
 
         # Unstaged changes
         unstagedFiles = unstagedDict.keys()
@@ -317,7 +323,10 @@ class IndexTab(object):
         self.stagedList.DeleteAllItems()
         for c in self.stagedChanges:
             pos = self.stagedList.GetItemCount()
-            self.stagedList.InsertStringItem(pos, '%s (%s)' % (c[0], MOD_DESCS[c[1]]))
+            if c[0] in self.renameSources:
+                self.stagedList.InsertStringItem(pos, '%s (%s from %s)' % (c[0], MOD_DESCS[c[1]], self.renameSources[c[0]]))
+            else:
+                self.stagedList.InsertStringItem(pos, '%s (%s)' % (c[0], MOD_DESCS[c[1]]))
 
         # Untracked files
         self.untrackedFiles = [ f for f in unstagedDict if unstagedDict[f] == FILE_UNTRACKED ]
@@ -414,8 +423,8 @@ class CommitWizard(Wizard.Wizard):
     def OnStart(self):
         # Check whether submodules have changes
         self.hasSubmoduleChanges = False
-        for module in self.repo.submodules:
-            unstagedChanges, stagedChanges = module.get_status()
+        statuses = git.executor.map(lambda module: module.get_status(), self.repo.submodules)
+        for unstagedChanges, stagedChanges in statuses:
             if unstagedChanges or stagedChanges:
                 self.hasSubmoduleChanges = True
                 break
@@ -424,7 +433,7 @@ class CommitWizard(Wizard.Wizard):
         self.isDetachedHead = (self.repo.current_branch == None)
 
         # Get default commit message from MERGE_MSG
-        mergemsg_file = os.path.join(self.repo.dir, '.git', 'MERGE_MSG')
+        mergemsg_file = os.path.join(self.repo.git_dir, 'MERGE_MSG')
         if os.path.exists(mergemsg_file):
             # Short msg
             f = open(mergemsg_file)
@@ -13,6 +13,9 @@ ID_CLOSEWINDOW  = 102
 TAB_HISTORY     = 0
 TAB_INDEX       = 1
 
+# Writing a commit-graph is offered for repositories with more objects
+COMMIT_GRAPH_MIN_OBJECTS = 100000
+
 class MainWindow(object):
     def __init__(self, repo):
         # Load frame from XRC
@@ -90,6 +93,11 @@ class MainWindow(object):
         self.historyTab.SaveState()
         self.indexTab.SaveState()
 
+        # Stop background git processes
+        if self.mainRepo:
+            for module in self.mainRepo.all_modules:
+                module.close()
+
         # Close window
         self.frame.Destroy()
         wx.TheApp.OnWindowClosed(self)
@@ -125,10 +133,11 @@ class MainWindow(object):
             title = "stupidgit - %s" % os.path.basename(repo.dir)
 
             for module in self.mainRepo.all_modules:
-                self.moduleChoice.Append(module.name)
+                self.moduleChoice.Append(module.full_name)
             
             self.moduleChoice.Select(0)
             self.SetRepo(repo)
+            wx.CallAfter(self.OfferCommitGraph, repo)
 
         else:
             title = "stupidgit"
@@ -136,6 +145,36 @@ class MainWindow(object):
 
         self.frame.SetTitle(title)
 
+    def OfferCommitGraph(self, repo):
+        # Reachability checks (e.g. finding lost commits) are much faster
+        # with a commit-graph file. A refusal is remembered per repository.
+        if not repo.object_db or repo.has_commit_graph():
+            return
+        if repo.object_db.packed_object_count() < COMMIT_GRAPH_MIN_OBJECTS:
+            return
+
+        declined = self.config.Read('CommitGraphDeclined', '').split('\n')
+        if repo.dir in declined:
+            return
+
+        msg = wx.MessageDialog(
+            self.frame,
+            "This repository has no commit-graph file. It makes some operations faster " +
+            "in large repositories (git commit-graph write --reachable).\n\n" +
+            "Do you want to write it now?",
+            "Commit-graph",
+            wx.ICON_QUESTION | wx.YES_NO | wx.YES_DEFAULT
+        )
+        if msg.ShowModal() == wx.ID_YES:
+            try:
+                busy = wx.BusyCursor()
+                repo.write_commit_graph()
+            except GitError, msg:
+                wx.MessageBox(str(msg), 'Error', style=wx.OK|wx.ICON_ERROR)
+        else:
+            declined.append(repo.dir)
+            self.config.Write('CommitGraphDeclined', '\n'.join([ d for d in declined if d ]))
+
     def SetRepo(self, repo):
         self.currentRepo = repo
         self.currentRepo.load_refs()
@@ -143,20 +182,18 @@ class MainWindow(object):
         self.indexTab.SetRepo(repo)
 
     def ReloadRepo(self):
-        self.currentRepo.load_refs()
         self.SetRepo(self.currentRepo)
 
-        # Load referenced version in submodules
-        for submodule in self.currentRepo.submodules:
-            submodule.load_refs()
+        # Load referenced version in submodules (the others load it on first use)
+        submodules = [ m for m in self.currentRepo.all_modules[1:] if m.refs_loaded ]
+        executor.map(lambda submodule: submodule.load_refs(), submodules)
 
     def OnModuleChosen(self, e):
         module_name = e.GetString()
-        module = [m for m in self.mainRepo.all_modules if m.name == module_name]
+        module = [m for m in self.mainRepo.all_modules if m.full_name == module_name]
         if module:
             self.SetRepo(module[0])
 
     def OnRefresh(self, e):
-        self.currentRepo.load_refs()
         self.SetRepo(self.currentRepo)
 
@@ -420,18 +420,19 @@ class SwitchWizard(wx.Dialog):
 
             for submodule in self.repo.submodules:
                 submodule.load_refs()
-                submodule.get_log(['--topo-order', '--all']) # Update commit pool
 
-                # Check existence of referenced commit
-                if submodule.main_ref not in git.commit_pool:
+                # Check existence of referenced commit (without loading
+                # the history of the submodule)
+                info = submodule.main_ref and submodule.object_info(submodule.main_ref)
+                if not info or info[1] != 'commit':
                     self.submoduleWarnings[submodule.name] = 'Referenced version cannot be found'
                     continue
-                commit = git.commit_pool[submodule.main_ref]
-                
+                commit_id = submodule.main_ref
+
                 # Check lost commits
-                lostCommits = submodule.get_lost_commits('HEAD', commit.sha1)
+                lostCommits = submodule.get_lost_commits('HEAD', commit_id)
                 if self.submoduleMode == SUBMODULE_MOVE_BRANCH and submodule.current_branch:
-                    lostCommits += submodule.get_lost_commits('refs/heads/%s' % submodule.current_branch, commit.sha1)
+                    lostCommits += submodule.get_lost_commits('refs/heads/%s' % submodule.current_branch, commit_id)
                 if lostCommits:
                     self.submoduleWarnings[submodule.name] = 'Switching to new version would result in lost commits'
                     continue
@@ -442,17 +443,17 @@ class SwitchWizard(wx.Dialog):
                     self.repo.run_cmd(['reset', submodule.name])
 
                     if self.submoduleMode == SUBMODULE_DETACHED_HEAD:
-                        submodule.run_cmd(['checkout', commit.sha1], raise_error=True)
+                        submodule.run_cmd(['checkout', commit_id], raise_error=True)
                     elif self.submoduleMode == SUBMODULE_NEW_BRANCH:
                         if self.submoduleBranchName in submodule.branches:
                             self.submoduleWarnings[submodule.name] = "Branch '%s' already exists!" % self.submoduleBranchName
                             continue
-                        submodule.run_cmd(['branch', self.submoduleBranchName, commit.sha1], raise_error=True)
+                        submodule.run_cmd(['branch', self.submoduleBranchName, commit_id], raise_error=True)
                         submodule.run_cmd(['checkout', self.submoduleBranchName], raise_error=True)
                     elif self.submoduleMode == SUBMODULE_MOVE_BRANCH:
-                        submodule.run_cmd(['checkout', commit.sha1], raise_error=True)
+                        submodule.run_cmd(['checkout', commit_id], raise_error=True)
                         if submodule.current_branch:
-                            submodule.run_cmd(['update-ref', 'refs/heads/%s' % submodule.current_branch, commit.sha1], raise_error=True)
+                            submodule.run_cmd(['update-ref', 'refs/heads/%s' % submodule.current_branch, commit_id], raise_error=True)
                             submodule.run_cmd(['checkout', submodule.current_branch], raise_error=True)
                 except git.GitError, e:
                     error_line = str(e).partition('\n')[2].strip()
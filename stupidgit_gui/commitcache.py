@@ -0,0 +1,178 @@
+import os
+import os.path
+import struct
+import binascii
+
+CACHE_FILENAME = 'stupidgit-commits'
+CACHE_MAGIC = 'SGCC'
+CACHE_VERSION = 3
+
+# Header: magic, version, commit count, tip count, parent count,
+# author count, length of key, authors and subjects
+HEADER_FORMAT = '<4sIIIIIIII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+class CommitCache(object):
+    # Parsed commits of a repository, stored in a binary file in the git
+    # directory. Records are tuples:
+    #
+    #   (sha1, [parent sha1s], author name, author date, timezone, subject)
+    #
+    # in topological order (children first). The cache always contains
+    # every ancestor of its tips, so new commits can be fetched with
+    # "git log <new tips> --not <cached tips>".
+    #
+    # The file contains columns of fixed size binary values (sha1 ids,
+    # dates, timezones, parent indexes) and NUL-separated strings, so loading it is
+    # a few bulk unpack and split operations.
+    def __init__(self, common_dir):
+        self.common_dir = common_dir
+        self.path = os.path.join(common_dir, CACHE_FILENAME)
+
+    def key(self):
+        # Shallow clones and grafts change the parents of existing
+        # commits: the cache is dropped if they change
+        stamps = []
+        for filename in ['shallow', os.path.join('info', 'grafts')]:
+            try:
+                st = os.stat(os.path.join(self.common_dir, filename))
+                stamps.append('%d:%d' % (st.st_mtime, st.st_size))
+            except OSError:
+                stamps.append('-')
+        return ','.join(stamps)
+
+    def load(self):
+        # Returns (tips, records). Both are empty if the cache does not
+        # exist or cannot be used.
+        try:
+            f = open(self.path, 'rb')
+            data = f.read()
+            f.close()
+        except (IOError, OSError):
+            return set(), []
+
+        try:
+            return self._parse(data)
+        except (struct.error, ValueError, IndexError, TypeError):
+            return set(), []
+
+    def save(self, tips, records):
+        data = self._serialize(tips, records)
+
+        # Another stupidgit instance may be writing the cache right now:
+        # the lock file makes sure that only one of them does it
+        lock_path = self.path + '.lock'
+        try:
+            fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError:
+            return False
+
+        try:
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+            if os.name != 'posix' and os.path.exists(self.path):
+                os.unlink(self.path)
+            os.rename(lock_path, self.path)
+            return True
+        except (IOError, OSError):
+            try:
+                os.unlink(lock_path)
+            except OSError:
+                pass
+            return False
+
+    def _parse(self, data):
+        (magic, version, count, tip_count, parent_count, author_count,
+         key_len, authors_len, subjects_len) = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            raise ValueError, "Unknown cache format"
+
+        pos = HEADER_SIZE
+        def take(size):
+            chunk = data[pos:pos+size]
+            if len(chunk) != size:
+                raise ValueError, "Truncated cache file"
+            return chunk, pos+size
+
+        key, pos = take(key_len)
+        if key != self.key():
+            raise ValueError, "Cache is out of date"
+
+        shas, pos = take(20 * count)
+        tip_shas, pos = take(20 * tip_count)
+        dates, pos = take(8 * count)
+        timezones, pos = take(2 * count)
+        parent_counts, pos = take(2 * count)
+        parent_indexes, pos = take(4 * parent_count)
+        author_indexes, pos = take(4 * count)
+        authors, pos = take(authors_len)
+        subjects, pos = take(subjects_len)
+
+        shas = binascii.hexlify(shas)
+        tip_shas = binascii.hexlify(tip_shas)
+        dates = struct.unpack('<%dq' % count, dates)
+        timezones = struct.unpack('<%dh' % count, timezones)
+        parent_counts = struct.unpack('<%dH' % count, parent_counts)
+        parent_indexes = struct.unpack('<%di' % parent_count, parent_indexes)
+        author_indexes = struct.unpack('<%di' % count, author_indexes)
+        authors = authors.split('\x00') if author_count else []
+        subjects = subjects.split('\x00') if count else []
+        if len(authors) != author_count or len(subjects) != count:
+            raise ValueError, "Corrupt cache file"
+
+        records = []
+        p = 0
+        for i in xrange(count):
+            pc = parent_counts[i]
+            parents = [ shas[40*j:40*j+40] for j in parent_indexes[p:p+pc] ]
+            p += pc
+            records.append((shas[40*i:40*i+40], parents, authors[author_indexes[i]],
+                            dates[i], timezones[i], subjects[i]))
+
+        tips = set([ tip_shas[40*i:40*i+40] for i in xrange(tip_count) ])
+        return tips, records
+
+    def _serialize(self, tips, records):
+        indexes = {}
+        for i in xrange(len(records)):
+            indexes[records[i][0]] = i
+
+        author_indexes = {}
+        authors = []
+        parent_counts = []
+        parent_indexes = []
+        author_list = []
+        for sha1, parents, author_name, author_date, author_tz, short_msg in records:
+            parents = [ indexes[p] for p in parents if p in indexes ]
+            parent_counts.append(len(parents))
+            parent_indexes += parents
+
+            if author_name not in author_indexes:
+                author_indexes[author_name] = len(authors)
+                authors.append(author_name)
+            author_list.append(author_indexes[author_name])
+
+        tips = [ tip for tip in tips if tip in indexes ]
+        key = self.key()
+        authors = '\x00'.join([ a.replace('\x00', '') for a in authors ])
+        subjects = '\x00'.join([ r[5].replace('\x00', '') for r in records ])
+
+        count = len(records)
+        return ''.join([
+            struct.pack(HEADER_FORMAT, CACHE_MAGIC, CACHE_VERSION, count,
+                        len(tips), len(parent_indexes), len(author_indexes),
+                        len(key), len(authors), len(subjects)),
+            key,
+            binascii.unhexlify(''.join([ r[0] for r in records ])),
+            binascii.unhexlify(''.join(tips)),
+            struct.pack('<%dq' % count, *[ r[3] for r in records ]),
+            struct.pack('<%dh' % count, *[ r[4] for r in records ]),
+            struct.pack('<%dH' % count, *parent_counts),
+            struct.pack('<%di' % len(parent_indexes), *parent_indexes),
+            struct.pack('<%di' % count, *author_list),
+            authors,
+            subjects
+        ])
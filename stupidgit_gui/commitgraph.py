@@ -0,0 +1,258 @@
+import os
+import os.path
+import mmap
+import struct
+import binascii
+import threading
+
+GRAPH_SIGNATURE = 'CGPH'
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+
+class CommitGraphError(RuntimeError): pass
+
+class CommitGraphFile(object):
+    # One commit-graph file, mapped into memory. Commits are numbered from
+    # base: files of a split commit-graph chain continue the numbering of
+    # their base files.
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base
+
+        f = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        try:
+            self._parse()
+        except (struct.error, IndexError):
+            self.close()
+            raise CommitGraphError, "Corrupt commit-graph file: %s" % path
+        except CommitGraphError:
+            self.close()
+            raise
+
+    def _parse(self):
+        data = self.data
+        signature, version, hash_version, chunk_count, base_count = struct.unpack('>4sBBBB', data[:8])
+        if signature != GRAPH_SIGNATURE or version != 1 or hash_version != 1:
+            raise CommitGraphError, "Unsupported commit-graph file: %s" % self.path
+
+        # Table of contents: chunk ids and offsets, terminated by a zero id
+        self.chunks = {}
+        for i in xrange(chunk_count):
+            pos = 8 + 12 * i
+            chunk_id, offset = struct.unpack('>4sQ', data[pos:pos+12])
+            self.chunks[chunk_id] = offset
+
+        for chunk_id in ['OIDF', 'OIDL', 'CDAT']:
+            if chunk_id not in self.chunks:
+                raise CommitGraphError, "Missing %s chunk in %s" % (chunk_id, self.path)
+
+        pos = self.chunks['OIDF']
+        self.fanout = struct.unpack('>256I', data[pos:pos+1024])
+        self.count = self.fanout[255]
+        self.sha_pos = self.chunks['OIDL']
+        self.data_pos = self.chunks['CDAT']
+        self.edge_pos = self.chunks.get('EDGE')
+
+        if len(data) < self.data_pos + 36 * self.count:
+            raise CommitGraphError, "Truncated commit-graph file: %s" % self.path
+
+    def close(self):
+        self.data.close()
+
+    def find(self, binsha):
+        # Returns the position of a commit in the whole graph or None
+        first = ord(binsha[0])
+        lo = self.fanout[first-1] if first else 0
+        hi = self.fanout[first]
+
+        data = self.data
+        while lo < hi:
+            mid = (lo + hi) / 2
+            start = self.sha_pos + 20 * mid
+            sha = data[start:start+20]
+            if sha < binsha:
+                lo = mid + 1
+            elif sha > binsha:
+                hi = mid
+            else:
+                return self.base + mid
+
+        return None
+
+    def sha1(self, i):
+        start = self.sha_pos + 20 * i
+        return binascii.hexlify(self.data[start:start+20])
+
+    def commit_data(self, i):
+        # Returns (first parent, second parent, generation, commit time):
+        # the raw fields of the commit data chunk
+        start = self.data_pos + 36 * i + 20 # after the tree id
+        parent1, parent2, gen_time, time_low = struct.unpack('>IIII', self.data[start:start+16])
+        return parent1, parent2, gen_time >> 2, ((gen_time & 3) << 32) | time_low
+
+    def extra_parents(self, i):
+        # Parents of octopus merges after the first one
+        parents = []
+        while True:
+            start = self.edge_pos + 4 * i
+            edge = struct.unpack('>I', self.data[start:start+4])[0]
+            parents.append(edge & ~GRAPH_LAST_EDGE)
+            if edge & GRAPH_LAST_EDGE:
+                return parents
+            i += 1
+
+class CommitGraph(object):
+    # Reads .git/objects/info/commit-graph (or a split commit-graph chain
+    # in info/commit-graphs) written by "git commit-graph write". Commits
+    # are identified by their integer position in the graph; parents,
+    # generation numbers and commit times are available without parsing
+    # commit objects.
+    #
+    # The graph covers the commits that existed when it was written, newer
+    # commits are not found. Files are reopened when git rewrites them.
+    # Lookups may come from other threads: they hold the lock so that the
+    # files cannot be closed while they are read.
+    def __init__(self, objects_dir):
+        self.info_dir = os.path.join(objects_dir, 'info')
+        self.files = []
+        self.count = 0
+        self.stamp = False # not loaded yet
+        self.lock = threading.Lock()
+
+    def load(self):
+        # Returns True if the repository has a commit-graph
+        self.lock.acquire()
+        try:
+            stamp = self._stamp()
+            if stamp != self.stamp:
+                self._close_files()
+                self.stamp = stamp
+                try:
+                    self._open_files()
+                except (IOError, OSError, mmap.error, CommitGraphError):
+                    self._close_files()
+
+            return len(self.files) > 0
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self._close_files()
+            self.stamp = False
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return self.count
+
+    def position(self, sha1):
+        # Returns the position of a commit or None if it is not in the graph
+        try:
+            binsha = binascii.unhexlify(sha1)
+        except TypeError:
+            return None
+
+        self.lock.acquire()
+        try:
+            for graph in self.files:
+                pos = graph.find(binsha)
+                if pos != None:
+                    return pos
+            return None
+        finally:
+            self.lock.release()
+
+    def sha1(self, pos):
+        self.lock.acquire()
+        try:
+            graph = self._file(pos)
+            return graph.sha1(pos - graph.base)
+        finally:
+            self.lock.release()
+
+    def parents(self, pos):
+        self.lock.acquire()
+        try:
+            graph = self._file(pos)
+            parent1, parent2, generation, commit_time = graph.commit_data(pos - graph.base)
+
+            parents = []
+            if parent1 != GRAPH_PARENT_NONE:
+                parents.append(parent1)
+            if parent2 & GRAPH_EXTRA_EDGES:
+                if graph.edge_pos == None:
+                    raise CommitGraphError, "Missing EDGE chunk in %s" % graph.path
+                parents += graph.extra_parents(parent2 & ~GRAPH_EXTRA_EDGES)
+            elif parent2 != GRAPH_PARENT_NONE:
+                parents.append(parent2)
+            return parents
+        finally:
+            self.lock.release()
+
+    def generation(self, pos):
+        # Topological level: greater than the generation of every parent
+        self.lock.acquire()
+        try:
+            graph = self._file(pos)
+            return graph.commit_data(pos - graph.base)[2]
+        finally:
+            self.lock.release()
+
+    def commit_time(self, pos):
+        self.lock.acquire()
+        try:
+            graph = self._file(pos)
+            return graph.commit_data(pos - graph.base)[3]
+        finally:
+            self.lock.release()
+
+    def _file(self, pos):
+        for graph in self.files:
+            if graph.base <= pos < graph.base + graph.count:
+                return graph
+        raise CommitGraphError, "Invalid commit-graph position: %d" % pos
+
+    def _stamp(self):
+        stamps = []
+        for path in [os.path.join(self.info_dir, 'commit-graph'),
+                     os.path.join(self.info_dir, 'commit-graphs', 'commit-graph-chain')]:
+            try:
+                st = os.stat(path)
+                stamps.append((st.st_mtime, st.st_size, st.st_ino))
+            except OSError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def _open_files(self):
+        # Like git, a single commit-graph file is preferred over a chain
+        path = os.path.join(self.info_dir, 'commit-graph')
+        if os.path.isfile(path):
+            paths = [path]
+        else:
+            chain_dir = os.path.join(self.info_dir, 'commit-graphs')
+            try:
+                f = open(os.path.join(chain_dir, 'commit-graph-chain'))
+                hashes = [ line.strip() for line in f.read().split('\n') if line.strip() ]
+                f.close()
+            except (IOError, OSError):
+                return
+            paths = [ os.path.join(chain_dir, 'graph-%s.graph' % h) for h in hashes ]
+
+        for path in paths:
+            graph = CommitGraphFile(path, self.count)
+            self.files.append(graph)
+            self.count += graph.count
+
+    def _close_files(self):
+        for graph in self.files:
+            graph.close()
+        self.files = []
+        self.count = 0
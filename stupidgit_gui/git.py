@@ -3,9 +3,19 @@ import os.path
 import sys
 import subprocess
 import re
+import gc
+import heapq
+import array
+import itertools
+import weakref
 import tempfile
 import threading
+import time
 from util import *
+from refstore import RefStore, RefStoreError
+from commitcache import CommitCache
+from objectdb import ObjectDatabase, ObjectDatabaseError
+from commitgraph import CommitGraph, CommitGraphError
 
 FILE_ADDED       = 'A'
 FILE_MODIFIED    = 'M'
@@ -50,7 +60,25 @@ MERGE_TOOLS = {
 }
 
 _git = None
-commit_pool = {}
+
+# Message bodies and e-mail addresses of commits are kept in memory up to
+# this size per repository (0: no limit). Least recently used ones are
+# dropped first, they are read again from git when needed. The rest of a
+# commit (sha1, parents, author, date, subject) is needed by the history
+# graph, it stays in memory as long as the pool.
+MAX_COMMIT_DETAILS_SIZE = 4 * 1024 * 1024
+
+# Number of commits that are added to the history at once by load_history
+HISTORY_PAGE_SIZE = 2000
+
+# Every CommitPool that is still in use (for commit_pool_stats)
+live_commit_pools = weakref.WeakKeyDictionary()
+
+# Approximate sizes of Python objects in bytes, for CommitPool.stats
+POINTER_SIZE = array.array('l').itemsize
+STRING_OVERHEAD = 5 * POINTER_SIZE
+DICT_ENTRY_SIZE = 3 * POINTER_SIZE
+COMMIT_VIEW_SIZE = 8 * POINTER_SIZE
 
 class GitError(RuntimeError): pass
 
@@ -104,7 +132,7 @@ def detect_mergetool():
     # Return error if no tool was found
     raise GitError, "Cannot detect any merge tool"
 
-def run_cmd(dir, args, with_retcode=False, with_stderr=False, raise_error=False, input=None, env={}, run_bg=False, setup_askpass=False):
+def run_cmd(dir, args, with_retcode=False, with_stderr=False, raise_error=False, input=None, env={}, run_bg=False, setup_askpass=False, stream=False, separator='\n'):
     # Check args
     if type(args) in [str, unicode]:
         args = [args]
@@ -114,11 +142,6 @@ def run_cmd(dir, args, with_retcode=False, with_stderr=False, raise_error=False,
     if not os.path.isdir(dir):
         raise GitError, 'Directory not exists: ' + dir
 
-    try:
-        os.chdir(dir)
-    except OSError, msg:
-        raise GitError, msg
-
     # Run command
     if type(args) != list:
         args = [args]
@@ -132,12 +155,32 @@ def run_cmd(dir, args, with_retcode=False, with_stderr=False, raise_error=False,
     
     preexec_fn = os.setsid if setup_askpass else None
 
-    p = Popen([git_binary()] + args, stdout=subprocess.PIPE,
-              stderr=subprocess.PIPE, stdin=subprocess.PIPE,
-              env=git_env, shell=False, preexec_fn=preexec_fn)
+    # The working directory is given per process: changing the directory of
+    # the whole application would not be safe when git runs from several
+    # threads at the same time.
+    if stream:
+        # stderr is collected in a file: if it was a pipe, git could block
+        # on it while we are waiting for stdout
+        stderr_file = tempfile.TemporaryFile()
+    else:
+        stderr_file = subprocess.PIPE
+
+    try:
+        p = Popen([git_binary()] + args, stdout=subprocess.PIPE,
+                  stderr=stderr_file, stdin=subprocess.PIPE,
+                  env=git_env, shell=False, preexec_fn=preexec_fn, cwd=dir)
+    except OSError, msg:
+        raise GitError, msg
+
     if run_bg:
         return p
 
+    if stream:
+        if input != None:
+            p.stdin.write(utf8_str(input))
+        p.stdin.close()
+        return _stream_output(p, stderr_file, separator, raise_error)
+
     if input == None:
         stdout,stderr = p.communicate('')
     else:
@@ -162,31 +205,266 @@ def run_cmd(dir, args, with_retcode=False, with_stderr=False, raise_error=False,
     else:
         return tuple(ret)
 
+# Git commands that can run in parallel (e.g. status of several modules)
+# are executed by a shared, bounded pool of worker threads
+MAX_GIT_WORKERS = 4
+executor = WorkerPool(MAX_GIT_WORKERS)
+
+def submit_cmd(dir, args, **opts):
+    # Same as run_cmd, but returns a Future immediately. Its result() method
+    # returns the output of run_cmd (or raises its exception).
+    return executor.submit(run_cmd, dir, args, **opts)
+
+STREAM_CHUNK_SIZE = 65536
+def _stream_output(p, stderr_file, separator, raise_error):
+    # Yields the records of the command output as they arrive. If the
+    # consumer stops early, the process is killed.
+    finished = False
+    try:
+        buf = ''
+        chunk = p.stdout.read(STREAM_CHUNK_SIZE)
+        while chunk:
+            records = (buf + chunk).split(separator)
+            buf = records.pop()
+            for record in records:
+                yield record
+
+            chunk = p.stdout.read(STREAM_CHUNK_SIZE)
+
+        if buf:
+            yield buf
+
+        p.wait()
+        finished = True
+
+        if p.returncode != 0 and raise_error:
+            stderr_file.seek(0)
+            raise GitError, 'git returned with the following error:\n%s' % stderr_file.read()
+    finally:
+        if not finished:
+            try:
+                p.kill()
+                p.wait()
+            except OSError:
+                pass
+        p.stdout.close()
+        stderr_file.close()
+
+class ObjectReader(object):
+    # A long-lived "git cat-file --batch" (or --batch-check) process. Objects
+    # are requested by writing their names to stdin and streamed back over
+    # the same pipe, so reading an object does not cost a fork/exec.
+    def __init__(self, dir, check_only=False):
+        self.dir = dir
+        self.check_only = check_only
+        self.process = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        mode = '--batch-check' if self.check_only else '--batch'
+        try:
+            self.process = Popen([git_binary(), 'cat-file', mode], cwd=self.dir,
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 stderr=open(os.devnull, 'w'), bufsize=-1)
+        except OSError, msg:
+            self.process = None
+            raise GitError, msg
+
+    def close(self):
+        if not self.process:
+            return
+
+        try:
+            self.process.stdin.close()
+            self.process.wait()
+        except (IOError, OSError):
+            pass
+
+        self.process = None
+
+    def read_object(self, spec):
+        return self.read_objects([spec])[0]
+
+    def read_objects(self, specs):
+        # Returns a list of (sha1, type, content) tuples in the order of specs.
+        # In check-only mode content is the object size. Objects that cannot
+        # be found are returned as None.
+        for spec in specs:
+            if '\n' in spec or not spec.strip():
+                raise GitError, "Invalid object name: %r" % spec
+
+        self.lock.acquire()
+        try:
+            try:
+                return self._read_objects(specs)
+            except (IOError, OSError, ValueError):
+                # The process died or the pipe got out of sync: restart
+                # it and try again once
+                self._kill()
+                try:
+                    return self._read_objects(specs)
+                except (IOError, OSError, ValueError):
+                    self._kill()
+                    raise GitError, "Cannot read objects from repository"
+        finally:
+            self.lock.release()
+
+    def _read_objects(self, specs):
+        if not self.process or self.process.poll() != None:
+            self.start()
+
+        result = []
+        pos = 0
+        while pos < len(specs):
+            # Send requests in chunks that surely fit into the pipe buffer,
+            # so that writing never blocks while git waits for us to read
+            chunk = []
+            chunk_size = 0
+            while pos < len(specs) and (not chunk or chunk_size + len(specs[pos]) < 4000):
+                chunk.append(specs[pos])
+                chunk_size += len(specs[pos]) + 1
+                pos += 1
+
+            self.process.stdin.write(''.join([str(s) + '\n' for s in chunk]))
+            self.process.stdin.flush()
+
+            for spec in chunk:
+                result.append(self._read_response())
+
+        return result
+
+    def _read_response(self):
+        stdout = self.process.stdout
+
+        header = stdout.readline()
+        if not header.endswith('\n'):
+            raise IOError, "Unexpected end of cat-file output"
+
+        if header.endswith(' missing\n') or header.endswith(' ambiguous\n'):
+            return None
+
+        sha1, objtype, size = header.split()
+        size = int(size)
+        if self.check_only:
+            return (sha1, objtype, size)
+
+        content = stdout.read(size)
+        if len(content) != size or stdout.read(1) != '\n':
+            raise IOError, "Unexpected end of cat-file output"
+
+        return (sha1, objtype, content)
+
+    def _kill(self):
+        if self.process:
+            try:
+                self.process.kill()
+                self.process.wait()
+            except (IOError, OSError):
+                pass
+        self.process = None
+
+def find_git_dir(workdir):
+    # Returns (git_dir, common_dir) if workdir is the top of a work tree,
+    # None otherwise. Only the .git entry is inspected, so this does not
+    # depend on the size of the work tree. .git may be a directory or a
+    # "gitdir: <path>" file (submodules, linked worktrees); linked worktrees
+    # share refs, objects and config with the main repository (common_dir).
+    dotgit = os.path.join(workdir, '.git')
+    if os.path.isdir(dotgit):
+        git_dir = dotgit
+    elif os.path.isfile(dotgit):
+        try:
+            f = open(dotgit)
+            content = f.read().strip()
+            f.close()
+        except (IOError, OSError):
+            return None
+
+        if not content.startswith('gitdir:'):
+            return None
+        git_dir = os.path.join(workdir, content[7:].strip())
+    else:
+        return None
+
+    git_dir = os.path.normpath(git_dir)
+    common_dir = git_dir
+    try:
+        f = open(os.path.join(git_dir, 'commondir'))
+        common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+        f.close()
+    except (IOError, OSError):
+        pass
+
+    if not os.path.isfile(os.path.join(git_dir, 'HEAD')) or \
+            not os.path.isdir(os.path.join(common_dir, 'objects')) or \
+            not os.path.isdir(os.path.join(common_dir, 'refs')):
+        return None
+
+    return git_dir, common_dir
+
+# Attributes set by Repository.load_refs
+LAZY_REF_ATTRIBUTES = set([
+    'refs', 'branches', 'remote_branches', 'tags', 'ref_types', 'upstreams',
+    'refs_by_sha1', 'branches_by_sha1', 'remote_branches_by_sha1', 'tags_by_sha1',
+    'head', 'current_branch', 'main_ref', 'main_merge_ref'
+])
+
 class Repository(object):
     def __init__(self, repodir, name='Main module', parent=None):
         self.name = name
         self.parent = parent
 
+        # Name shown to the user (path from the main module for nested submodules)
+        if parent and parent.parent:
+            self.full_name = '%s/%s' % (parent.full_name, name)
+        else:
+            self.full_name = name
+
         # Search for .git directory in repodir ancestors
         repodir = os.path.abspath(repodir)
         try:
+            git_dirs = find_git_dir(repodir)
             if parent:
-                if not os.path.isdir(os.path.join(repodir, '.git')):
+                if not git_dirs:
                     raise GitError, "Not a git repository: %s" % repodir
             else:
-                while not os.path.isdir(os.path.join(repodir, '.git')):
+                while not git_dirs:
                     new_repodir = os.path.abspath(os.path.join(repodir, '..'))
                     if new_repodir == repodir or (parent and new_repodir == parent.dir):
                         raise GitError, "Directory is not a git repository"
                     else:
                         repodir = new_repodir
+                        git_dirs = find_git_dir(repodir)
         except OSError:
             raise GitError, "Directory is not a git repository or it is not readable"
             
         self.dir = repodir
+        self.git_dir, self.common_dir = git_dirs
+
+        # Object readers are started on first use
+        self.object_reader = ObjectReader(self.dir)
+        self.object_checker = ObjectReader(self.dir, check_only=True)
+        self.object_db = None # see below
+
+        # Reference caches
+        self.ref_store = RefStore(self.git_dir, self.common_dir)
+        self._ref_list = None
+        self._ref_fingerprint = None
+        self.ref_snapshot = None
+        self._ref_source = (None, None, None)
+        self._upstreams = (None, {})
+        self._tag_cache = {}
+        self._submodule_versions = {}
+
+        # Commits of the history graph (see get_history)
+        self.commit_cache = CommitCache(self.common_dir)
+        self.commit_pool = CommitPool(self)
+        self._history = None # (tips, CommitPool)
+        self._history_lock = threading.Lock()
+        self.commit_graph = CommitGraph(os.path.join(self.common_dir, 'objects'))
 
         # Remotes
-        self.config = ConfigFile(os.path.join(self.dir, '.git', 'config'))
+        self.config = ConfigFile(os.path.join(self.common_dir, 'config'))
         self.url = self.config.get_option('remote', 'origin', 'url')
 
         self.remotes = {}
@@ -194,76 +472,311 @@ class Repository(object):
             if 'url' in opts:
                 self.remotes[remote] = opts['url']
 
-        # Run a git status to see whether this is really a git repository
-        retcode,output = self.run_cmd(['status'], with_retcode=True)
-        if retcode not in [0,1]:
-            raise GitError, "Directory is not a git repository"
+        # Objects given by sha1 are read directly from .git/objects, unless
+        # the repository uses another hash function than SHA-1
+        extensions = self.config.options_for_section(None, 'extensions') or {}
+        object_format = [ v for k, v in extensions.iteritems() if k.lower() == 'objectformat' ]
+        if not object_format or object_format[0].lower() == 'sha1':
+            self.object_db = ObjectDatabase(os.path.join(self.common_dir, 'objects'))
+
+        # References of submodules are loaded on first use (see __getattr__)
+        self._refs_lock = threading.RLock()
+        self.refs_loaded = False
 
         # Load refs
-        self.load_refs()
+        if not parent:
+            self.load_refs()
 
-        # Get submodule info
+        # Get submodule info (including nested submodules)
         self.submodules = self.get_submodules()
-        self.all_modules = [self] + self.submodules
+        self.all_modules = [self]
+        for submodule in self.submodules:
+            self.all_modules += submodule.all_modules
 
-    def load_refs(self):
-        self.refs = {}
-        self.branches = {}
-        self.remote_branches = {}
-        self.tags = {}
+        # Load submodule refs in the background
+        if not parent:
+            for module in self.all_modules[1:]:
+                executor.submit(module.ensure_refs)
 
-        # HEAD, current branch
-        self.head = self.run_cmd(['rev-parse', 'HEAD']).strip()
-        self.current_branch = None
+    def __getattr__(self, name):
+        # Only called for attributes that are not set yet
+        if name in LAZY_REF_ATTRIBUTES:
+            self.ensure_refs()
+            return self.__dict__[name]
+
+        raise AttributeError, name
+
+    def ensure_refs(self):
+        self._refs_lock.acquire()
         try:
-            f = open(os.path.join(self.dir, '.git', 'HEAD'))
-            head = f.read().strip()
-            f.close()
+            if not self.refs_loaded:
+                self.load_refs()
+        finally:
+            self._refs_lock.release()
 
-            if head.startswith('ref: refs/heads/'):
-                self.current_branch = head[16:]
-        except OSError:
-            pass
+    def load_refs(self):
+        self._refs_lock.acquire()
+        try:
+            self._load_refs()
+            self.refs_loaded = True
+        finally:
+            self._refs_lock.release()
 
+    def _load_refs(self):
         # Main module references
         if self.parent:
-            self.main_ref = self.parent.get_submodule_version(self.name, 'HEAD')
-            if os.path.exists(os.path.join(self.parent.dir, '.git', 'MERGE_HEAD')):
-                self.main_merge_ref = self.parent.get_submodule_version(self.name, 'MERGE_HEAD')
+            parent_head, parent_branch = self.parent._resolve_head()
+            self.main_ref = self.parent.get_submodule_version(self.name, parent_head)
+            merge_head = read_sha1_file(os.path.join(self.parent.git_dir, 'MERGE_HEAD'))
+            if merge_head:
+                self.main_merge_ref = self.parent.get_submodule_version(self.name, merge_head)
             else:
                 self.main_merge_ref = None
         else:
             self.main_ref = None
             self.main_merge_ref = None
 
+        # Nothing to do if HEAD, the ref files and the reflog of HEAD are
+        # untouched since the last call
+        fingerprint = (self.ref_store.fingerprint(), self.main_ref, self.main_merge_ref)
+        if fingerprint == self._ref_fingerprint:
+            return
+
         # References
-        for line in self.run_cmd(['show-ref']).split('\n'):
-            commit_id, _, refname = line.partition(' ')
-            self.refs[refname] = commit_id
+        try:
+            ref_list = self._read_refs()
+        except RefStoreError:
+            ref_list = self._read_refs_from_git()
+            fingerprint = None
+
+        if ref_list is not self._ref_list:
+            self._ref_list = ref_list
+
+            self.refs = {}
+            self.branches = {}
+            self.remote_branches = {}
+            self.tags = {}
+            self.ref_types = {}
+            self.upstreams = {}
+
+            for refname, commit_id, objtype, tag_commit, upstream in ref_list:
+                self.refs[refname] = commit_id
+                self.ref_types[refname] = objtype
+
+                if refname.startswith('refs/heads/'):
+                    branchname = refname[11:]
+                    self.branches[branchname] = commit_id
+                    if upstream:
+                        self.upstreams[branchname] = upstream
+                elif refname.startswith('refs/remotes/'):
+                    branchname = refname[13:]
+                    self.remote_branches[branchname] = commit_id
+                elif refname.startswith('refs/tags/'):
+                    # Tags are shown at the referenced commit
+                    if tag_commit:
+                        self.tags[refname[10:]] = tag_commit
+
+            # Inverse reference hashes
+            self.refs_by_sha1 = invert_hash(self.refs)
+            self.branches_by_sha1 = invert_hash(self.branches)
+            self.remote_branches_by_sha1 = invert_hash(self.remote_branches)
+            self.tags_by_sha1 = invert_hash(self.tags)
 
-            if refname.startswith('refs/heads/'):
-                branchname = refname[11:]
-                self.branches[branchname] = commit_id
-            elif refname.startswith('refs/remotes/'):
-                branchname = refname[13:]
-                self.remote_branches[branchname] = commit_id
+        # HEAD, current branch
+        self.head, self.current_branch = self._resolve_head()
+
+        # Snapshot of everything that is shown in the history graph.
+        # Snapshots are replaced (not modified) when refs change, so
+        # comparing two snapshots by identity is enough to detect changes.
+        snapshot = {}
+        for refname, commit_id, objtype, tag_commit, upstream in ref_list:
+            if refname.startswith('refs/tags/'):
+                snapshot[refname] = tag_commit
+            else:
+                snapshot[refname] = commit_id
+        snapshot['HEAD'] = (self.head, self.current_branch)
+        snapshot['MAIN/HEAD'] = self.main_ref
+        snapshot['MAIN/MERGE_HEAD'] = self.main_merge_ref
+
+        if snapshot != self.ref_snapshot:
+            self.ref_snapshot = snapshot
+
+        self._ref_fingerprint = fingerprint
+
+    def _resolve_head(self):
+        # Returns the sha1 id of HEAD ('HEAD' in an empty repository)
+        # and the name of the current branch
+        head = self.ref_store.read_head()
+        if head and head.startswith('ref: refs/heads/'):
+            branch = head[16:]
+            try:
+                refs = self.ref_store.load()[0]
+                return refs.get('refs/heads/' + branch, 'HEAD'), branch
+            except RefStoreError:
+                return self.run_cmd(['rev-parse', 'HEAD']).strip(), branch
+        elif head and re.match('^[0-9a-f]{40}$', head):
+            return head, None
+        else:
+            return self.run_cmd(['rev-parse', 'HEAD']).strip(), None
+
+    def _read_refs(self):
+        # Reads refs without running git. Returns the same list object
+        # if nothing has changed since the last call.
+        refs, peeled = self.ref_store.load()
+        upstreams = self._read_upstreams()
+
+        if refs is self._ref_source[0] and upstreams is self._ref_source[1]:
+            return self._ref_source[2]
+
+        # Find out the type and the referenced commit of tags that are not
+        # peeled in packed-refs (with a single batch of requests to cat-file).
+        # Objects never change, so the results are cached.
+        unknown_tags = [ sha1 for refname, sha1 in refs.iteritems()
+                         if refname.startswith('refs/tags/') and refname not in peeled
+                         and sha1 not in self._tag_cache ]
+        if unknown_tags:
+            specs = []
+            for sha1 in unknown_tags:
+                specs += [sha1, '%s^{commit}' % sha1]
+            infos = self.object_infos(specs)
+            for i in xrange(len(unknown_tags)):
+                obj, commit = infos[2*i], infos[2*i+1]
+                self._tag_cache[unknown_tags[i]] = (obj and obj[1], commit and commit[0])
+
+        ref_list = []
+        for refname, sha1 in refs.iteritems():
+            tag_commit = None
+            if refname in peeled:
+                objtype = 'tag'
+                tag_commit = peeled[refname]
             elif refname.startswith('refs/tags/'):
-                # Load the referenced commit for tags
-                tagname = refname[10:]
-                try:
-                    self.tags[tagname] = self.run_cmd(['rev-parse', '%s^{commit}' % refname], raise_error=True).strip()
-                except GitError:
-                    pass
+                objtype, tag_commit = self._tag_cache[sha1]
+            else:
+                objtype = 'commit'
+                tag_commit = sha1
+
+            if refname.startswith('refs/heads/'):
+                upstream = upstreams.get(refname[11:])
+            else:
+                upstream = None
+
+            ref_list.append((refname, sha1, objtype, tag_commit, upstream))
+
+        self._ref_source = (refs, upstreams, ref_list)
+        return ref_list
+
+    def _read_upstreams(self):
+        # Upstream branches from the repository config
+        config_file = os.path.join(self.common_dir, 'config')
+        try:
+            stamp = os.stat(config_file).st_mtime
+        except OSError:
+            return {}
+
+        if stamp != self._upstreams[0]:
+            upstreams = {}
+            for branch, opts in ConfigFile(config_file).sections_for_type('branch'):
+                remote, merge = opts.get('remote'), opts.get('merge')
+                if not remote or not merge:
+                    continue
+
+                if remote == '.':
+                    upstreams[branch] = merge
+                elif merge.startswith('refs/heads/'):
+                    upstreams[branch] = 'refs/remotes/%s/%s' % (remote, merge[11:])
+
+            self._upstreams = (stamp, upstreams)
+
+        return self._upstreams[1]
+
+    def _read_refs_from_git(self):
+        # Every ref with its type, peeled object and upstream branch is
+        # listed by a single git command
+        ref_list = []
+
+        output = self.run_cmd(['for-each-ref', '--format=%(refname)%00%(objectname)%00%(objecttype)%00%(*objectname)%00%(*objecttype)%00%(upstream)'])
+        for line in output.split('\n'):
+            fields = line.split('\x00')
+            if len(fields) != 6:
+                continue
+
+            refname, commit_id, objtype, peeled_id, peeled_type, upstream = fields
+            if objtype == 'commit':
+                tag_commit = commit_id
+            elif peeled_type == 'commit':
+                tag_commit = peeled_id
+            elif peeled_type == 'tag':
+                # Tag of a tag: let git peel it
+                obj = self.object_info('%s^{commit}' % refname)
+                tag_commit = obj and obj[0]
+            else:
+                tag_commit = None
 
-        # Inverse reference hashes
-        self.refs_by_sha1 = invert_hash(self.refs)
-        self.branches_by_sha1 = invert_hash(self.branches)
-        self.remote_branches_by_sha1 = invert_hash(self.remote_branches)
-        self.tags_by_sha1 = invert_hash(self.tags)
+            ref_list.append((refname, commit_id, objtype, tag_commit, upstream))
+
+        return ref_list
 
     def run_cmd(self, args, **opts):
         return run_cmd(self.dir, args, **opts)
 
+    def submit_cmd(self, args, **opts):
+        return submit_cmd(self.dir, args, **opts)
+
+    def read_object(self, spec):
+        # Returns (sha1, type, content) of an object given by any object
+        # name that git understands (sha1, HEAD:file, :2:file etc.)
+        obj = self.read_objects([spec])[0]
+        if not obj:
+            raise GitError, "Object not found: %s" % spec
+
+        return obj
+
+    def read_objects(self, specs):
+        return self._lookup_objects(specs, self.object_reader, 'read')
+
+    def object_info(self, spec):
+        # Returns (sha1, type, size) or None if object does not exist
+        return self.object_infos([spec])[0]
+
+    def object_infos(self, specs):
+        return self._lookup_objects(specs, self.object_checker, 'info')
+
+    def _lookup_objects(self, specs, reader, method):
+        # Objects given by sha1 come from the object database, other object
+        # names (and objects it cannot read) from git cat-file
+        result = [None] * len(specs)
+        missing = range(len(specs))
+
+        if self.object_db:
+            lookup = getattr(self.object_db, method)
+            missing = []
+            for i in xrange(len(specs)):
+                if re.match('^[0-9a-f]{40}$', specs[i]):
+                    try:
+                        result[i] = lookup(specs[i])
+                    except ObjectDatabaseError:
+                        pass
+                if not result[i]:
+                    missing.append(i)
+
+        if missing:
+            objs = reader.read_objects([ specs[i] for i in missing ])
+            for i, obj in itertools.izip(missing, objs):
+                result[i] = obj
+
+        return result
+
+    def close(self):
+        self.object_reader.close()
+        self.object_checker.close()
+        if self.object_db:
+            self.object_db.close()
+        self.commit_graph.close()
+
+        # Free the commits of the history graph
+        self.commit_pool = CommitPool(self)
+        self._history = None
+
     def get_submodules(self):
         # Check existence of .gitmodules
         gitmodules_path = os.path.join(self.dir, '.gitmodules')
@@ -281,6 +794,16 @@ class Repository(object):
         return repos
 
     def get_submodule_version(self, submodule_name, main_version):
+        # Versions in a given commit never change, so they are cached
+        if re.match('^[0-9a-f]{40}$', main_version):
+            key = (main_version, submodule_name)
+            if key not in self._submodule_versions:
+                self._submodule_versions[key] = self._get_submodule_version(submodule_name, main_version)
+            return self._submodule_versions[key]
+        else:
+            return self._get_submodule_version(submodule_name, main_version)
+
+    def _get_submodule_version(self, submodule_name, main_version):
         dir = os.path.dirname(submodule_name)
         name = os.path.basename(submodule_name)
         output = self.run_cmd(['ls-tree', '-z', '%s:%s' % (main_version, dir)])
@@ -296,23 +819,156 @@ class Repository(object):
         return None
 
     def get_log(self, args=[]):
-        log = self.run_cmd(['log', '-z', '--date=relative', '--pretty=format:%H%n%h%n%P%n%T%n%an%n%ae%n%ad%n%s%n%b']+args)
-        
-        if len(log) == 0:
-            return []
-
-        commit_texts = log.split('\x00')
-        commit_texts.reverse()
+        # Parse commits as git outputs them, so that the whole log text
+        # is never kept in memory
+        log = self.run_cmd(['log'] + HISTORY_ARGS + args,
+                           stream=True, separator='\x00')
+        records = [ parse_history_record(text) for text in log ]
+
+        return CommitPool(self, records).commits
+
+    def get_history(self):
+        # Commits of every reference in topological order, like
+        # get_log(['--topo-order', '--all']). See load_history.
+        #
+        # The garbage collector would scan the new objects again and again
+        # while they are created, but none of them is garbage yet.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for pool in self.load_history():
+                pass
+            return pool.commits
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def load_history(self, page_size=HISTORY_PAGE_SIZE):
+        # Loads the commits of every reference into a new CommitPool and
+        # yields the pool each time a page of commits has been added, so
+        # the history can be shown while it is still loading. When the
+        # generator finishes, the pool becomes self.commit_pool.
+        #
+        # Commits that have already been read (in this or an earlier
+        # session) come from the commit cache, git is asked only for
+        # commits that are reachable from new tips.
+        self._history_lock.acquire()
+        try:
+            for pool in self._load_history(page_size):
+                yield pool
+        finally:
+            self._history_lock.release()
+
+    def _load_history(self, page_size):
+        self.ensure_refs()
+
+        tips = set([ tag_commit for refname, commit_id, objtype, tag_commit, upstream in self._ref_list if tag_commit ])
+        if self.head != 'HEAD':
+            tips.add(self.head)
+
+        if self._history == None:
+            cached_tips, records = self.commit_cache.load()
+            self._history = (cached_tips, CommitPool(self, records))
+        cached_tips, pool = self._history
+
+        # Tags may point to other objects than commits
+        new_tips = [ tip for tip in tips if tip not in pool ]
+        if new_tips:
+            infos = self.object_infos(new_tips)
+            new_tips = [ info[0] for info in infos if info and info[1] == 'commit' ]
+        old_tips = [ tip for tip in tips if tip in pool ]
+
+        # The pool contains every ancestor of the cached tips: git is asked
+        # only for commits that are not reachable from them. Cached tips
+        # that have been garbage collected cannot be excluded.
+        gone_tips = [ tip for tip in cached_tips if tip not in tips ]
+        excluded_tips = old_tips + [ info[0] for info in self.object_infos(gone_tips) if info ]
+        if not excluded_tips:
+            # Nothing is excluded, the whole history is read
+            pool = CommitPool(self)
+
+        if new_tips:
+            # New commits come first, then the known ones
+            new_pool = CommitPool(self, complete=False)
+            try:
+                for page in self._pages(self._new_history_records(pool, new_tips, excluded_tips), page_size):
+                    new_pool.append(page)
+                    yield new_pool
+            except GitError:
+                # Start from scratch if the cache cannot be used
+                new_pool = CommitPool(self, complete=False)
+                for page in self._pages(self._read_history_records(new_tips + old_tips, []), page_size):
+                    new_pool.append(page)
+                    yield new_pool
+                pool = CommitPool(self)
+
+            for first in xrange(0, len(pool), page_size):
+                new_pool.append([ pool.record(i) for i in xrange(first, min(first + page_size, len(pool))) ])
+                yield new_pool
+            new_pool.finish()
+            pool = new_pool
+
+        if not cached_tips.issubset(tips):
+            # Some commits may not be reachable anymore: the whole graph
+            # is needed to find them. The history has already been shown,
+            # the pruned pool replaces it.
+            reachable = array.array('b', [0]) * len(pool)
+            stack = [ pool.indexes[tip] for tip in tips if tip in pool ]
+            while stack:
+                i = stack.pop()
+                if not reachable[i]:
+                    reachable[i] = 1
+                    stack.extend(pool.parents_of(i))
+
+            if reachable.count(1) != len(pool):
+                pool = CommitPool(self, [ pool.record(i) for i in xrange(len(pool)) if reachable[i] ])
+                yield pool
+            elif not new_tips:
+                yield pool
+
+        elif not new_tips:
+            yield pool
+
+        tips = set([ tip for tip in tips if tip in pool ])
+        if tips != cached_tips or pool is not self._history[1]:
+            self._history = (tips, pool)
+            self.commit_cache.save(tips, pool.records())
+
+        self.commit_pool = pool
+
+    def _pages(self, records, page_size):
+        page = []
+        for record in records:
+            page.append(record)
+            if len(page) == page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def _new_history_records(self, pool, tips, excluded_tips):
+        # Commits reachable from tips that are not in the pool yet
+        if not tips:
+            return
 
-        commits = []
-        for text in commit_texts:
-            c = Commit(self)
-            c.parse_gitlog_output(text)
-            commit_pool[c.sha1] = c
-            commits.append(c)
+        for record in self._read_history_records(tips, excluded_tips):
+            if record[0] not in pool:
+                yield record
+
+    def _read_history_records(self, tips, excluded_tips):
+        # Reads commits reachable from tips but not from excluded_tips.
+        # Revisions are passed on stdin, there may be thousands of them.
+        # Without excluded tips this is a full read: --all gives the same
+        # order as the history had before the cache.
+        args = ['log', '--topo-order'] + HISTORY_ARGS
+        if excluded_tips:
+            revs = '\n'.join(tips + [ '^' + tip for tip in excluded_tips ]) + '\n'
+            log = self.run_cmd(args + ['--stdin'], input=revs, stream=True, separator='\x00', raise_error=True)
+        else:
+            log = self.run_cmd(args + ['--all'], stream=True, separator='\x00', raise_error=True)
 
-        commits.reverse()
-        return commits
+        for text in log:
+            yield parse_history_record(text)
 
     def commit(self, author_name, author_email, msg, amend=False):
         if amend:
@@ -338,7 +994,7 @@ class Repository(object):
             # Get merge head if exists
             is_merge_resolve = False
             try:
-                merge_head_filename = os.path.join(self.dir, '.git', 'MERGE_HEAD')
+                merge_head_filename = os.path.join(self.git_dir, 'MERGE_HEAD')
                 if os.path.isfile(merge_head_filename):
                     f = open(merge_head_filename)
                     p = f.read().strip()
@@ -374,69 +1030,58 @@ class Repository(object):
         # Remove MERGE_HEAD
         if is_merge_resolve:
             try:
-                os.unlink(os.path.join(self.dir, '.git', 'MERGE_HEAD'))
-                os.unlink(os.path.join(self.dir, '.git', 'MERGE_MODE'))
-                os.unlink(os.path.join(self.dir, '.git', 'MERGE_MSG'))
-                os.unlink(os.path.join(self.dir, '.git', 'ORIG_HEAD'))
+                os.unlink(os.path.join(self.git_dir, 'MERGE_HEAD'))
+                os.unlink(os.path.join(self.git_dir, 'MERGE_MODE'))
+                os.unlink(os.path.join(self.git_dir, 'MERGE_MSG'))
+                os.unlink(os.path.join(self.git_dir, 'ORIG_HEAD'))
             except OSError:
                 pass
 
     def get_status(self):
-        unstaged_changes = {}
-        staged_changes = {}
-
-        # Unstaged changes
-        changes = self.run_cmd(['diff', '--name-status', '-z']).split('\x00')
-        for i in xrange(len(changes)/2):
-            status, filename = changes[2*i], changes[2*i+1]
-            if filename not in unstaged_changes or status == FILE_UNMERGED:
-                unstaged_changes[filename] = status
-
-        # Untracked files
-        for filename in self.run_cmd(['ls-files', '--others', '--exclude-standard', '-z']).split('\x00'):
-            if filename and filename not in unstaged_changes:
-                unstaged_changes[filename] = FILE_UNTRACKED
-
-        # Staged changes
-        if self.head == 'HEAD':
-            # Initial commit
-            for filename in self.run_cmd(['ls-files', '--cached', '-z']).split('\x00'):
-                if filename:
-                    staged_changes[filename] = FILE_ADDED
-        else:
-            changes = self.run_cmd(['diff', '--cached', '--name-status', '-z']).split('\x00')
-            for i in xrange(len(changes)/2):
-                status, filename = changes[2*i], changes[2*i+1]
-                if status != FILE_UNMERGED or filename not in unstaged_changes:
-                    staged_changes[filename] = status
-
-        return unstaged_changes, staged_changes
+        status = self.get_full_status()
+        return status.unstaged, status.staged
 
     def get_unified_status(self):
-        unified_changes = {}
-
-        # Staged & unstaged changes
-        changes = self.run_cmd(['diff', 'HEAD', '--name-status', '-z']).split('\x00')
-        for i in xrange(len(changes)/2):
-            status, filename = changes[2*i], changes[2*i+1]
-            if filename not in unified_changes or status == FILE_UNMERGED:
-                unified_changes[filename] = status
-
-        # Untracked files
-        for filename in self.run_cmd(['ls-files', '--others', '--exclude-standard', '-z']).split('\x00'):
-            if filename and filename not in unified_changes:
-                unified_changes[filename] = FILE_UNTRACKED
-
-        return unified_changes
+        return self.get_full_status().unified
+
+    def get_full_status(self):
+        # A single "git status" walks the index and the work tree only once.
+        # --porcelain=v2 needs git 2.11: an older git must not look like a
+        # clean work tree.
+        status = Status()
+
+        records = self.run_cmd(['status', '--porcelain=v2', '-z', '--untracked-files=all'],
+                               stream=True, separator='\x00', raise_error=True)
+        for record in records:
+            if record.startswith('1 '):
+                # Ordinary changed entry
+                fields = record.split(' ', 8)
+                status.add_entry(fields[8], fields[1], fields[2])
+            elif record.startswith('2 '):
+                # Renamed or copied entry, followed by the original path
+                fields = record.split(' ', 9)
+                status.add_entry(fields[9], fields[1], fields[2], records.next())
+            elif record.startswith('u '):
+                # Unmerged entry
+                fields = record.split(' ', 10)
+                status.add_unmerged(fields[10], fields[2])
+            elif record.startswith('? '):
+                status.add_untracked(record[2:])
+
+        return status
 
     def merge_file(self, filename):
         # Store file versions in temporary files
+        local_obj, remote_obj = self.read_objects([':2:%s' % filename, ':3:%s' % filename])
+        if not local_obj or not remote_obj:
+            raise GitError, "File is not unmerged: %s" % filename
+
         fd, local_file = tempfile.mkstemp(prefix=os.path.basename(filename) + '.LOCAL.')
-        os.write(fd, self.run_cmd(['show', ':2:%s' % filename], raise_error=True))
+        os.write(fd, local_obj[2])
         os.close(fd)
 
         fd, remote_file = tempfile.mkstemp(prefix=os.path.basename(filename) + '.REMOTE.')
-        os.write(fd, self.run_cmd(['show', ':3:%s' % filename], raise_error=True))
+        os.write(fd, remote_obj[2])
         os.close(fd)
         
         # Run mergetool
@@ -459,7 +1104,6 @@ class Repository(object):
             commit_id = self.head
         else:
             commit_id = self.refs[refname]
-        commit = commit_pool[commit_id]
 
         # If commit is not moving, it won't be lost :)
         if commit_id == moving_to:
@@ -470,6 +1114,25 @@ class Repository(object):
         if (refname == 'HEAD' and head_refnum > 0) or head_refnum > 1:
             return []
 
+        # With a commit-graph, exactly those commits are lost that are not
+        # reachable from other references
+        if self.has_commit_graph():
+            kept_commits = [ tag_commit for ref, sha1, objtype, tag_commit, upstream in self._ref_list
+                             if ref != refname and tag_commit ]
+            if moving_to:
+                kept_commits.append(moving_to)
+            if refname != 'HEAD' and not self.current_branch:
+                kept_commits.append(self.head)
+
+            try:
+                return self.get_commits(self._unreachable_commits(commit_id, kept_commits))
+            except (GitError, CommitGraphError):
+                pass
+
+        if commit_id not in self.commit_pool:
+            self.get_history()
+        commit = self.commit_pool[commit_id]
+
         # If commit has descendants, it won't be lost: at least one of its
         # descendants has another reference
         if commit.children:
@@ -499,9 +1162,111 @@ class Repository(object):
 
         return lost_commits
 
+    def has_commit_graph(self):
+        return self.commit_graph.load()
+
+    def write_commit_graph(self):
+        self.run_cmd(['commit-graph', 'write', '--reachable'], raise_error=True)
+        self.commit_graph.load()
+
+    def _unreachable_commits(self, commit_id, kept_commits):
+        # Returns the ancestors of commit_id (including itself) that are not
+        # ancestors of kept_commits, children first.
+        #
+        # Commits are visited in the order of decreasing generation number:
+        # when a commit is visited, every commit that can reach it has
+        # been visited already, so its flags are final. The walk stops when
+        # only kept commits are waiting.
+        LOST, KEPT = 1, 2
+        generations = {}
+        flags = {}
+        queue = []
+        waiting_lost = [0] # number of queued commits that are only LOST
+
+        def mark(sha1, flag):
+            old_flags = flags.get(sha1, 0)
+            if old_flags | flag == old_flags:
+                return
+
+            flags[sha1] = old_flags | flag
+            if not old_flags:
+                heapq.heappush(queue, (-self._commit_generation(sha1, generations), sha1))
+            if flags[sha1] == LOST:
+                waiting_lost[0] += 1
+            elif old_flags == LOST:
+                waiting_lost[0] -= 1
+
+        mark(commit_id, LOST)
+        for sha1 in kept_commits:
+            mark(sha1, KEPT)
+
+        unreachable = []
+        while waiting_lost[0] > 0:
+            generation, sha1 = heapq.heappop(queue)
+            if flags[sha1] == LOST:
+                waiting_lost[0] -= 1
+                unreachable.append(sha1)
+
+            for parent in self._commit_parents(sha1):
+                mark(parent, flags[sha1])
+
+        return unreachable
+
+    def _commit_parents(self, commit_id):
+        # Parents from the commit-graph or (for newer commits) from the
+        # commit object
+        pos = self.commit_graph.position(commit_id)
+        if pos != None:
+            graph = self.commit_graph
+            return [ graph.sha1(p) for p in graph.parents(pos) ]
+
+        obj = self.read_object(commit_id)
+        if obj[1] != 'commit':
+            raise GitError, "Not a commit: %s" % commit_id
+        return parse_commit_record(commit_id, obj[2])[1]
+
+    def _commit_generation(self, commit_id, generations):
+        # Generation number of a commit (see CommitGraph.generation). Commits
+        # that are newer than the commit-graph get one more than their
+        # parents, those are computed without recursion.
+        stack = [commit_id]
+        while stack:
+            sha1 = stack[-1]
+            if sha1 in generations:
+                stack.pop()
+                continue
+
+            pos = self.commit_graph.position(sha1)
+            if pos != None:
+                generations[sha1] = self.commit_graph.generation(pos)
+                stack.pop()
+                continue
+
+            parents = self._commit_parents(sha1)
+            unknown = [ p for p in parents if p not in generations ]
+            if unknown:
+                stack += unknown
+            else:
+                generations[sha1] = max([0] + [ generations[p] for p in parents ]) + 1
+                stack.pop()
+
+        return generations[commit_id]
+
+    def get_commits(self, commit_ids):
+        # Commit objects of the given commits (children first), read from
+        # the object database. Parents and children of these commits only
+        # include the given commits.
+        records = []
+        for commit_id, obj in itertools.izip(commit_ids, self.read_objects(commit_ids)):
+            if not obj or obj[1] != 'commit':
+                raise GitError, "Commit not found: %s" % commit_id
+            records.append(parse_commit_record(commit_id, obj[2]))
+
+        return CommitPool(self, records).commits
+
     def update_head(self, content):
         try:
-            f = open(os.path.join(self.dir, '.git', 'HEAD'), 'w')
+            f = open(os.path.join(self.git_dir, 'HEAD'), 'w')
             f.write(content)
             f.close()
         except OSError:
@@ -520,47 +1285,430 @@ class Repository(object):
 
         return t
 
-class Commit(object):
-    def __init__(self, repo):
-        self.repo = repo
-
-        self.sha1 = None
-        self.abbrev = None
-
-        self.parents = None
-        self.children = None
-        self.tree = None
-
-        self.author_name = None
-        self.author_email = None
-        self.author_date = None
+# Fields of a commit that the history graph needs: sha1, parents, subject,
+# author name and author date (epoch and timezone, see --date=raw).
+# Everything else is read from the commit objects when it is first needed
+# (see CommitPool.load_details).
+HISTORY_FORMAT = '%H%n%P%n%s%n%an%n%ad'
+HISTORY_ARGS = ['-z', '--date=raw', '--pretty=format:' + HISTORY_FORMAT]
+
+def parse_history_record(text):
+    # Parses an entry of git log HISTORY_ARGS
+    sha1, parents, short_msg, author_name, author_date = text.split('\n')
+    timestamp, timezone = author_date.split()
+    return (sha1, parents.split(), author_name, int(timestamp), parse_timezone(timezone), short_msg)
+
+def parse_timezone(timezone):
+    # '+0130' => 90 (minutes east of UTC)
+    try:
+        minutes = int(timezone[1:3]) * 60 + int(timezone[3:5])
+    except ValueError:
+        return 0
 
-        self.short_msg = None
-        self.full_msg = None
+    if timezone.startswith('-'):
+        return -minutes
+    else:
+        return minutes
+
+# Number of commit objects that are read at once by CommitPool.get_details
+DETAILS_BATCH_SIZE = 64
+
+def parse_commit_details(content):
+    # Returns (tree, author e-mail, message body) of a raw commit object.
+    # The body does not include the subject paragraph, like %b.
+    headers, _, message = content.partition('\n\n')
+
+    tree = author_email = ''
+    for line in headers.split('\n'):
+        if line.startswith('tree '):
+            tree = line[5:]
+        elif line.startswith('author '):
+            m = re.search('<([^>]*)>', line)
+            if m:
+                author_email = m.group(1)
+            break
+
+    subject, _, body = message.partition('\n\n')
+    return (tree, author_email, body)
+
+def parse_commit_record(sha1, content):
+    # Returns a history record (see parse_history_record) of a raw commit object
+    headers, _, message = content.partition('\n\n')
+
+    parents = []
+    author_name = ''
+    author_date = author_tz = 0
+    for line in headers.split('\n'):
+        if line.startswith('parent '):
+            parents.append(line[7:])
+        elif line.startswith('author '):
+            m = re.match('author (.*?) ?<[^>]*> (\d+) ([+-]\d{4})', line)
+            if m:
+                author_name = m.group(1)
+                author_date = int(m.group(2))
+                author_tz = parse_timezone(m.group(3))
+
+    # The subject is the first paragraph in one line, like %s
+    subject = message.lstrip('\n').partition('\n\n')[0]
+    short_msg = ' '.join([ l.strip() for l in subject.strip().split('\n') ])
+    return (sha1, parents, author_name, author_date, author_tz, short_msg)
+
+class CommitPool(object):
+    # Commits of a history in struct-of-arrays form: every commit has an
+    # integer index, parents and children are stored as flat int arrays,
+    # author names are stored only once. Commit objects are light views
+    # into the pool.
+    #
+    # Commits are added in topological order (see append), possibly from
+    # another thread than the one that reads the pool: the first len(pool)
+    # commits are always complete. Pools that are filled page by page are
+    # created with complete=False and finished with finish().
+    def __init__(self, repo, records=[], complete=True):
+        self.repo = repo
+        self.complete = False
+        self.missing_parents = 0
+
+        self.sha1s = []
+        self.indexes = {}
+        self.dates = array.array('d')
+        self.timezones = array.array('h')
+        self.subjects = []
+
+        self.authors = []
+        self.author_ids = array.array('i')
+        self._author_ids = {}
+
+        # Parents of commit i:
+        #   parent_indexes[parent_starts[i]:parent_starts[i]+parent_counts[i]]
+        # Parents that are not loaded yet (or are not in the history at
+        # all, e.g. in shallow clones) are -1. Children are stored the same
+        # way, they are ordered like git log orders them: later entries first.
+        self.parent_starts = array.array('i')
+        self.parent_counts = array.array('i')
+        self.parent_indexes = array.array('i')
+        self.child_starts = array.array('i')
+        self.child_counts = array.array('i')
+        self.child_indexes = array.array('i')
+        self._waiting_parents = {} # sha1 => [(child index, position in parent_indexes)]
+
+        self.details = {} # index => (author e-mail, message body)
+        self.details_size = 0
+        self.details_used = {} # index => last use (see get_details)
+        self.details_clock = 0
+        self.commits = []
+
+        self.append(records)
+        if complete:
+            self.finish()
+        live_commit_pools[self] = True
+
+    def finish(self):
+        # No more commits are added: parents that are still missing are
+        # not part of the history (shallow clones)
+        self.missing_parents = len(self._waiting_parents)
+        self._waiting_parents = {}
+        self.complete = True
+
+    def append(self, records):
+        # Adds commits that come after the existing ones in topological
+        # order: all of their children are already in the pool
+        first = len(self.sha1s)
+        indexes = self.indexes
+        waiting = self._waiting_parents
+
+        for sha1, parents, author_name, author_date, author_tz, short_msg in records:
+            i = len(self.sha1s)
+            self.sha1s.append(sha1)
+            indexes[sha1] = i
+            self.dates.append(author_date)
+            self.timezones.append(author_tz)
+            self.subjects.append(short_msg)
+
+            author_id = self._author_ids.get(author_name)
+            if author_id == None:
+                author_id = self._author_ids[author_name] = len(self.authors)
+                self.authors.append(author_name)
+            self.author_ids.append(author_id)
+
+            self.parent_starts.append(len(self.parent_indexes))
+            self.parent_counts.append(len(parents))
+            for p in parents:
+                if p not in waiting:
+                    waiting[p] = []
+                waiting[p].append((i, len(self.parent_indexes)))
+                self.parent_indexes.append(indexes.get(p, -1))
+
+            # Children were added earlier, now their parent is known
+            children = waiting.pop(sha1, [])
+            children.reverse()
+            self.child_starts.append(len(self.child_indexes))
+            self.child_counts.append(len(children))
+            for child, position in children:
+                self.parent_indexes[position] = i
+                self.child_indexes.append(child)
+
+        self.commits.extend([ Commit(self, i) for i in xrange(first, len(self.sha1s)) ])
+
+    def __len__(self):
+        return len(self.commits)
+
+    def __contains__(self, sha1):
+        return self.indexes.get(sha1, len(self.commits)) < len(self.commits)
+
+    def __getitem__(self, sha1):
+        return self.commits[self.indexes[sha1]]
+
+    def record(self, index):
+        # Commit in the form of CommitCache records
+        return (self.sha1s[index], [ self.sha1s[p] for p in self.parents_of(index) ],
+                self.authors[self.author_ids[index]], int(self.dates[index]),
+                self.timezones[index], self.subjects[index])
+
+    def records(self):
+        return [ self.record(i) for i in xrange(len(self.commits)) ]
+
+    def parents_of(self, index):
+        start = self.parent_starts[index]
+        return [ p for p in self.parent_indexes[start:start+self.parent_counts[index]] if p >= 0 ]
+
+    def children_of(self, index):
+        start = self.child_starts[index]
+        return self.child_indexes[start:start+self.child_counts[index]]
+
+    def get_details(self, index):
+        # Fields that are not needed by the history graph:
+        # (tree, author e-mail, message body). Commits near the requested
+        # one are likely to be needed soon, so they are read in the same
+        # batch.
+        self.details_clock += 1
+        if index not in self.details:
+            first = max(0, index - DETAILS_BATCH_SIZE/2)
+            self.load_details(xrange(first, min(len(self.commits), first + DETAILS_BATCH_SIZE)), index)
+
+        self.details_used[index] = self.details_clock
+        return self.details[index]
+
+    def load_details(self, indexes, keep=None):
+        # Reads the commit objects of the given commits with a single
+        # request to the repository. The details of keep are not evicted
+        # to make room for the others.
+        indexes = [ i for i in indexes if i not in self.details ]
+        if not indexes:
+            return
 
-        self.remote_branches = None
-        self.branches = None
-        self.tags = None
+        objects = self.repo.read_objects([ self.sha1s[i] for i in indexes ])
+        for i, obj in itertools.izip(indexes, objects):
+            if obj:
+                details = parse_commit_details(obj[2])
+            else:
+                details = ('', '', '')
+
+            self.details[i] = details
+            self.details_used[i] = self.details_clock
+            self.details_size += sum([ len(d) for d in details ])
+
+        if MAX_COMMIT_DETAILS_SIZE and self.details_size > MAX_COMMIT_DETAILS_SIZE:
+            self.evict_details(MAX_COMMIT_DETAILS_SIZE * 3 / 4, keep)
+
+    def evict_details(self, max_size=0, keep=None):
+        # Drops least recently used details until they fit in max_size
+        by_use = sorted(self.details_used.iteritems(), key=lambda item: item[1])
+        for index, last_use in by_use:
+            if self.details_size <= max_size:
+                break
+            if index == keep:
+                continue
 
-    def parse_gitlog_output(self, text):
-        lines = text.split('\n')
+            details = self.details.pop(index)
+            del self.details_used[index]
+            self.details_size -= sum([ len(d) for d in details ])
+
+    def stats(self):
+        # Number of commits and approximate memory usage in bytes
+        nbytes = 0
+        for values in [ self.dates, self.timezones, self.author_ids,
+                        self.parent_starts, self.parent_counts, self.parent_indexes,
+                        self.child_starts, self.child_counts, self.child_indexes ]:
+            nbytes += len(values) * values.itemsize
+
+        for strings in [ self.sha1s, self.subjects, self.authors ]:
+            nbytes += sum([ len(s) for s in strings ])
+            nbytes += len(strings) * (STRING_OVERHEAD + POINTER_SIZE)
+
+        nbytes += len(self.indexes) * DICT_ENTRY_SIZE
+        nbytes += len(self.commits) * (COMMIT_VIEW_SIZE + POINTER_SIZE)
+        nbytes += self.details_size
+
+        return {
+            'commits': len(self.commits),
+            'authors': len(self.authors),
+            'details': len(self.details),
+            'bytes': nbytes
+        }
+
+def commit_pool_stats():
+    # Summary of every commit pool that is still in memory
+    total = { 'pools': 0, 'commits': 0, 'authors': 0, 'details': 0, 'bytes': 0 }
+    for pool in live_commit_pools.keys():
+        total['pools'] += 1
+        for key, value in pool.stats().iteritems():
+            total[key] += value
+    return total
 
-        (self.sha1, self.abbrev, parents, self.tree,
-         self.author_name, self.author_email, self.author_date,
-         self.short_msg) = lines[0:8]
+class Commit(object):
+    # A commit in a CommitPool
+    __slots__ = ['pool', 'index']
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+
+    @property
+    def repo(self):
+        return self.pool.repo
+
+    @property
+    def sha1(self):
+        return self.pool.sha1s[self.index]
+
+    @property
+    def abbrev(self):
+        return self.pool.sha1s[self.index][:7]
+
+    @property
+    def parent_count(self):
+        # Number of parents in the history. While the pool is loading,
+        # parents that are not loaded yet are counted too.
+        pool = self.pool
+        count = pool.parent_counts[self.index]
+        if pool.complete and pool.missing_parents:
+            start = pool.parent_starts[self.index]
+            count -= pool.parent_indexes[start:start+count].count(-1)
+        return count
+
+    @property
+    def parents(self):
+        commits = self.pool.commits
+        return [ commits[i] for i in self.pool.parents_of(self.index) ]
+
+    @property
+    def children(self):
+        commits = self.pool.commits
+        return [ commits[i] for i in self.pool.children_of(self.index) ]
+
+    @property
+    def tree(self):
+        return self.pool.get_details(self.index)[0]
+
+    @property
+    def author_name(self):
+        return self.pool.authors[self.pool.author_ids[self.index]]
+
+    @property
+    def author_timestamp(self):
+        return int(self.pool.dates[self.index])
+
+    @property
+    def author_timezone(self):
+        # Minutes east of UTC
+        return self.pool.timezones[self.index]
+
+    @property
+    def author_date(self):
+        # Formatted when asked: the text depends on the current time
+        return format_relative_date(self.author_timestamp)
+
+    @property
+    def author_date_absolute(self):
+        return format_date(self.author_timestamp, self.author_timezone)
+
+    @property
+    def short_msg(self):
+        return self.pool.subjects[self.index]
+
+    @property
+    def author_email(self):
+        return self.pool.get_details(self.index)[1]
+
+    @property
+    def full_msg(self):
+        return self.pool.get_details(self.index)[2]
+
+class RefChanges(object):
+    # Difference of two ref snapshots (see Repository.load_refs)
+    def __init__(self, old_snapshot, new_snapshot):
+        self.added = {}   # refname => new value
+        self.moved = {}   # refname => (old value, new value)
+        self.deleted = {} # refname => old value
+
+        if old_snapshot is new_snapshot:
+            return
 
-        if parents:
-            parent_ids = parents.split(' ')
-            self.parents = [commit_pool[p] for p in parent_ids]
-            for parent in self.parents:
-                parent.children.append(self)
+        old_snapshot = old_snapshot or {}
+        new_snapshot = new_snapshot or {}
+        for refname, value in new_snapshot.iteritems():
+            if refname not in old_snapshot:
+                self.added[refname] = value
+            elif old_snapshot[refname] != value:
+                self.moved[refname] = (old_snapshot[refname], value)
+        for refname, value in old_snapshot.iteritems():
+            if refname not in new_snapshot:
+                self.deleted[refname] = value
+
+    def __nonzero__(self):
+        return bool(self.added or self.moved or self.deleted)
+
+    def changed_refs(self):
+        return self.added.keys() + self.moved.keys() + self.deleted.keys()
+
+class Status(object):
+    # Parsed output of "git status --porcelain=v2"
+    def __init__(self):
+        self.unstaged = {}       # filename => status (work tree vs. index)
+        self.staged = {}         # filename => status (index vs. HEAD)
+        self.unified = {}        # filename => status (work tree vs. HEAD)
+        self.rename_sources = {} # filename => original filename
+        self.submodules = {}     # submodule path => (commit changed, modified, untracked)
+
+    def add_entry(self, filename, xy, sub, orig_filename=None):
+        staged, unstaged = xy[0], xy[1]
+
+        if staged != '.':
+            self.staged[filename] = staged
+        if unstaged != '.':
+            self.unstaged[filename] = unstaged
+        if orig_filename != None:
+            self.rename_sources[filename] = orig_filename
+        self._add_submodule(filename, sub)
+
+        # Status compared to HEAD
+        if staged == FILE_ADDED:
+            if unstaged != FILE_DELETED:
+                self.unified[filename] = FILE_ADDED
+        elif FILE_DELETED in xy:
+            self.unified[filename] = FILE_DELETED
+        elif staged in [FILE_RENAMED, FILE_COPIED]:
+            self.unified[filename] = staged
+        elif FILE_TYPECHANGED in xy:
+            self.unified[filename] = FILE_TYPECHANGED
         else:
-            self.parents = []
-
-        self.children = []
-
-        self.full_msg = '\n'.join(lines[8:])
-
+            self.unified[filename] = FILE_MODIFIED
+
+    def add_unmerged(self, filename, sub):
+        self.unstaged[filename] = FILE_UNMERGED
+        self.unified[filename] = FILE_UNMERGED
+        self._add_submodule(filename, sub)
+
+    def add_untracked(self, filename):
+        if filename not in self.unstaged:
+            self.unstaged[filename] = FILE_UNTRACKED
+        if filename not in self.unified:
+            self.unified[filename] = FILE_UNTRACKED
+
+    def _add_submodule(self, filename, sub):
+        # sub is "N..." for files and "S<c><m><u>" for submodules
+        if sub.startswith('S'):
+            self.submodules[filename] = (sub[1] == 'C', sub[2] == 'M', sub[3] == 'U')
 
 class ConfigFile(object):
     def __init__(self, filename):
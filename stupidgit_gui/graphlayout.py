@@ -0,0 +1,481 @@
+import heapq
+import bisect
+
+NODE_NORMAL   = 0
+NODE_BRANCH   = 1
+NODE_MERGE    = 2
+NODE_JUNCTION = 3
+
+EDGE_DIRECT = 0
+EDGE_BRANCH = 1
+EDGE_MERGE  = 2
+
+# Edges are indexed by blocks of this many rows for painting
+EDGE_BLOCK_ROWS = 64
+
+# Rows are laid out in blocks of this many rows (see CommitList). The
+# lane state is saved at the end of every block: a new layout of a
+# changed history is compared with the previous one at these points.
+BLOCK_ROWS = 256
+
+# A new layout gives up reusing the previous one if their states did not
+# match at this many checkpoints, or if the rows to compare for a pending
+# merge reach further back than this
+RELAYOUT_ATTEMPTS = 40
+RELAYOUT_CHECK_ROWS = 4096
+
+class GraphNode(object):
+    def __init__(self, commit):
+        self.commit = commit
+        self.x = None
+        self.y = None
+        self.color = None
+
+        self.parent_edges = []
+        self.child_edges  = []
+        self.references   = []
+
+        self.parent_count = commit.parent_count
+        child_count = len(commit.children)
+        if self.parent_count > 1 and child_count > 1:
+            self.style = NODE_JUNCTION
+        elif self.parent_count > 1:
+            self.style = NODE_MERGE
+        elif child_count > 1:
+            self.style = NODE_BRANCH
+        else:
+            self.style = NODE_NORMAL
+
+    def moved(self, commit, y, color):
+        # The same node in another layout (without edges)
+        node = GraphNode.__new__(GraphNode)
+        node.commit = commit
+        node.x = self.x
+        node.y = y
+        node.color = color
+        node.parent_edges = []
+        node.child_edges  = []
+        node.references   = []
+        node.parent_count = self.parent_count
+        node.style = self.style
+        return node
+
+class GraphEdge(object):
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+
+        self.style = None
+        self.color = None
+        self.x = None
+        self.color = None
+
+class GraphLayout(object):
+    # Assigns columns to the commits of a history (in topological order)
+    # and to the edges between them, row by row. Rows can be added later
+    # when more commits are loaded (see layout).
+    #
+    # Every lane holds the last node that was put in it until all of
+    # the node's parent edges are drawn. A commit continues the leftmost
+    # lane of its children or gets the leftmost free lane: lanes of
+    # nodes are found by lane_of and free lanes are kept in a heap, so
+    # a row costs only as much as the number of edges it has.
+    #
+    # Merge edges get the first column right of both ends where no node
+    # and no other edge is in the way. Occupied rows are kept per column
+    # as sorted, merged ranges, so a column is checked with a binary
+    # search instead of a scan over the rows that the edge spans.
+    #
+    # Every edge is stored once: it is drawn in column edge.x on the rows
+    # from its child (dst) to its parent (src). Edges that cross a row
+    # are found through the blocks of rows that they span.
+    #
+    # When the history changes (new commits on top after a commit or a
+    # fetch, moved or deleted branches), the layout of the new history is
+    # given the previous layout. Rows are laid out normally until the
+    # lane state matches a checkpoint of the previous layout: from there
+    # on the rows would come out the same, so the previous nodes and
+    # edges are copied to their new rows instead (see _reuse_rows).
+    #
+    # The layout may be built in another thread than the one that paints
+    # it. Rows, edges and edge blocks are only appended to, nodes and
+    # edges of the laid out rows do not change anymore: snapshot() gives
+    # a view of the rows that are laid out so far.
+    def __init__(self, commits, previous=None):
+        self.commits = commits
+        self.rows = []  # row => GraphNode
+        self.nodes = {} # commit => GraphNode
+        self.edges = [] # in the order of placement
+        self.edge_blocks = [] # block => edges that cross it
+        self.columns = 0
+
+        self.lanes = []        # lane => GraphNode or None
+        self.lane_of = {}      # GraphNode => lane
+        self.free_lanes = []   # heap of lanes that may be None
+        self.root_nodes = []   # nodes without parents, they end their lane in the next row
+        self.pending = set()   # nodes that wait for parent edges
+        self.color = 0
+
+        self.occupied = []     # column => ([first rows], [last rows]) of occupied ranges
+        self.checkpoints = {}  # row count => (lanes, root nodes, color, [(pending node, parent edge count)])
+
+        # A layout that is still taking rows from its own previous layout
+        # does not have a lane state to compare with
+        self.previous = None
+        self.reuse = None
+        if previous and previous.checkpoints and not previous.previous:
+            self.previous = previous
+            self.anchors = dict([ (previous.rows[count-1].commit.sha1, count) for count in previous.checkpoints ])
+            self.attempts = 0
+
+    def layout(self, end):
+        # Lays out the graph up to row end (exclusive). Returns the first
+        # row that has changed: rows may be laid out again (in new lists)
+        # if the previous layout turns out to be unusable.
+        end = min(end, len(self.commits))
+        first = len(self.rows)
+        while len(self.rows) < end:
+            if self.reuse:
+                if not self._reuse_rows(end):
+                    first = 0
+            else:
+                self._layout_rows(end)
+        return first
+
+    def snapshot(self):
+        return GraphSnapshot(self)
+
+    def _layout_rows(self, end):
+        # Lays out rows up to end or until the previous layout can be used
+        rows = self.rows
+        nodes = self.nodes
+        lanes = self.lanes
+        lane_of = self.lane_of
+        free_lanes = self.free_lanes
+        pending = self.pending
+        color = self.color
+
+        for y in xrange(len(rows), end):
+            # 1. Create node
+            commit = self.commits[y]
+            node = GraphNode(commit)
+            nodes[commit] = node
+            node.y = y
+            rows.append(node)
+
+            # 2. Determine column
+            x = None
+
+            # 2.1. continue the leftmost lane of the children
+            children = [ nodes[c] for c in commit.children ]
+            for child in children:
+                lane = lane_of.get(child)
+                if lane != None and (x == None or lane < x):
+                    x = lane
+                    node.color = child.color
+
+            # 2.2. if there is no such lane, put to the first empty place
+            if x == None:
+                node.color = color
+                color += 1
+                while free_lanes and lanes[free_lanes[0]] != None:
+                    heapq.heappop(free_lanes)
+                if free_lanes:
+                    x = heapq.heappop(free_lanes)
+                else:
+                    x = len(lanes)
+                    lanes.append(None)
+
+            node.x = x
+            self.columns = max(self.columns, x)
+
+            # 3. Create edges
+            for child in children:
+                edge = GraphEdge(node, child)
+                node.child_edges.append(edge)
+                child.parent_edges.append(edge)
+
+                # 3.1. Determine edge style
+                if child.x == node.x and lanes[x] == child:
+                    edge.style = EDGE_DIRECT
+                    edge.x = node.x
+                    edge.color = child.color
+                elif child.parent_count == 1:
+                    edge.style = EDGE_BRANCH
+                    edge.x = child.x
+                    edge.color = child.color
+                else:
+                    edge.style = EDGE_MERGE
+                    edge.color = node.color
+
+                    # Determine column for merge edges
+                    edge.x = max(node.x, child.x+1)
+                    while not self._is_free(edge.x, child.y+1, node.y):
+                        edge.x += 1
+
+                # 3.2. Register edge
+                self._occupy(edge.x, child.y+1, node.y)
+                self.edges.append(edge)
+                self._index_edge(edge)
+                self.columns = max(self.columns, edge.x)
+
+                if len(child.parent_edges) == child.parent_count:
+                    pending.discard(child)
+
+            # The node itself does not block its own merge edges
+            self._occupy(x, y, y)
+
+            # 4. End those lanes whose parents are already drawn: only
+            # the children got new parent edges in this row
+            ending = children + self.root_nodes
+            self.root_nodes = []
+            for n in ending:
+                lane = lane_of.get(n)
+                if lane != None and len(n.parent_edges) == n.parent_count:
+                    lanes[lane] = None
+                    del lane_of[n]
+                    heapq.heappush(free_lanes, lane)
+
+            if lanes[x] != None:
+                del lane_of[lanes[x]]
+            lanes[x] = node
+            lane_of[node] = x
+            if node.parent_count == 0:
+                self.root_nodes.append(node)
+            else:
+                pending.add(node)
+
+            # 5. Save the lane state, compare it with the previous layout
+            if (y+1) % BLOCK_ROWS == 0:
+                self.color = color
+                self.checkpoints[y+1] = (lanes[:], self.root_nodes[:], color,
+                                         [ (n, len(n.parent_edges)) for n in pending ])
+            if self.previous and commit.sha1 in self.anchors:
+                self.color = color
+                if self._match_previous(y):
+                    return
+
+        self.color = color
+
+    def _match_previous(self, y):
+        # Compares the state after row y with the checkpoint of the
+        # previous layout after the same commit. If they match, rows
+        # from y+1 on are taken from the previous layout.
+        previous = self.previous
+        count = self.anchors[self.commits[y].sha1]
+        lanes, root_nodes, color, pending = previous.checkpoints[count]
+        offset = y+1 - count
+
+        self.attempts += 1
+        if self.attempts > RELAYOUT_ATTEMPTS:
+            self.previous = None
+            return False
+
+        if (len(lanes) != len(self.lanes) or len(root_nodes) != len(self.root_nodes) or
+            len(pending) != len(self.pending)):
+            return False
+
+        # Nodes that are still in lanes or wait for parents must be the
+        # same commits in the same places, colours may be numbered
+        # differently
+        pairs = []
+        for old, new in zip(lanes, self.lanes):
+            if (old == None) != (new == None):
+                return False
+            if old != None:
+                pairs.append((old, new))
+        pairs += zip(root_nodes, self.root_nodes)
+
+        pending_nodes = dict([ (node.commit.sha1, node) for node in self.pending ])
+        for old, edge_count in pending:
+            new = pending_nodes.get(old.commit.sha1)
+            if not new or len(new.parent_edges) != edge_count:
+                return False
+            pairs.append((old, new))
+
+        replaced = {}
+        colors = {}
+        for old, new in pairs:
+            if (old.commit.sha1 != new.commit.sha1 or old.x != new.x or old.y + offset != new.y or
+                old.parent_count != new.parent_count):
+                return False
+            if colors.setdefault(old.color, new.color) != new.color:
+                return False
+            replaced[old] = new
+
+        # Merge edges of the pending nodes are placed around the rows
+        # between them and row y, those rows must be the same too
+        merges = [ node.y for node in self.pending if node.parent_count > 1 ]
+        if merges:
+            start = min(merges) + 1
+            if y+1 - start > RELAYOUT_CHECK_ROWS:
+                return False
+            if self._occupied_rows(start, y, 0) != previous._occupied_rows(start - offset, y - offset, offset):
+                return False
+
+        self.reuse = (offset, replaced, colors, self.color - color, color)
+        return True
+
+    def _occupied_rows(self, start, end, offset):
+        # Columns and rows of the nodes and edges placed in rows start..end
+        # (inclusive), moved by offset rows
+        occupied = set()
+        for node in self.rows[start:end+1]:
+            occupied.add((node.x, node.y + offset, node.y + offset))
+        for edge in self.snapshot().edges_in_rows(start, end):
+            if edge.src.y <= end:
+                occupied.add((edge.x, max(edge.dst.y+1, start) + offset, edge.src.y + offset))
+        return occupied
+
+    def _reuse_rows(self, end):
+        # Copies rows of the previous layout up to row end (exclusive) to
+        # this one. Returns False if the histories turn out to differ:
+        # the layout is then started again without the previous one.
+        #
+        # The previous layout is not changed, it may still be shown.
+        # Its nodes are mapped to their copies in replaced.
+        previous = self.previous
+        offset, replaced, colors, color_shift, first_color = self.reuse
+        rows = self.rows
+        nodes = self.nodes
+        commits = self.commits
+
+        def recolor(color):
+            if color < first_color:
+                return colors.get(color, color)
+            return color + color_shift
+
+        for y in xrange(len(rows), end):
+            if y - offset >= len(previous.rows):
+                break
+
+            old = previous.rows[y - offset]
+            commit = commits[y]
+            if old.commit.sha1 != commit.sha1:
+                self._restart()
+                return False
+
+            node = old.moved(commit, y, recolor(old.color))
+            replaced[old] = node
+            rows.append(node)
+            nodes[commit] = node
+
+            for old_edge in old.child_edges:
+                child = replaced[old_edge.dst]
+                edge = GraphEdge(node, child)
+                edge.style = old_edge.style
+                edge.x = old_edge.x
+                edge.color = recolor(old_edge.color)
+                node.child_edges.append(edge)
+                child.parent_edges.append(edge)
+
+                self._occupy(edge.x, child.y+1, y)
+                self.edges.append(edge)
+                self._index_edge(edge)
+                self.columns = max(self.columns, edge.x)
+
+            self._occupy(node.x, y, y)
+            self.columns = max(self.columns, node.x)
+
+            checkpoint = previous.checkpoints.get(y+1 - offset)
+            if checkpoint:
+                lanes, root_nodes, color, pending = checkpoint
+                self.checkpoints[y+1] = ([ replaced.get(n) for n in lanes ],
+                                         [ replaced[n] for n in root_nodes ],
+                                         color + color_shift,
+                                         [ (replaced[n], edge_count) for n, edge_count in pending ])
+
+        if len(rows) - offset < len(previous.rows):
+            return True
+
+        # Every row of the previous layout has been taken, so has its state
+        self.lanes = [ replaced.get(n) for n in previous.lanes ]
+        self.lane_of = dict([ (replaced[n], lane) for n, lane in previous.lane_of.iteritems() ])
+        self.free_lanes = previous.free_lanes[:]
+        self.root_nodes = [ replaced[n] for n in previous.root_nodes ]
+        self.pending = set([ replaced[n] for n in previous.pending ])
+        self.color = previous.color + color_shift
+        self.previous = None
+        self.reuse = None
+        return True
+
+    def _restart(self):
+        # Forgets every row. Snapshots keep the old lists.
+        self.__init__(self.commits)
+
+    def _index_edge(self, edge):
+        # An edge crosses rows dst.y+1..src.y
+        first = (edge.dst.y + 1) / EDGE_BLOCK_ROWS
+        last = edge.src.y / EDGE_BLOCK_ROWS
+        while len(self.edge_blocks) <= last:
+            self.edge_blocks.append([])
+        for block in xrange(first, last+1):
+            self.edge_blocks[block].append(edge)
+
+    def _is_free(self, column, start, end):
+        # True if nothing occupies rows start..end (inclusive) in column
+        if column >= len(self.occupied):
+            return True
+
+        starts, ends = self.occupied[column]
+        i = bisect.bisect_right(starts, end) - 1
+        return i < 0 or ends[i] < start
+
+    def _occupy(self, column, start, end):
+        while len(self.occupied) <= column:
+            self.occupied.append(([], []))
+
+        # Merge with the overlapping and adjacent ranges
+        starts, ends = self.occupied[column]
+        i = bisect.bisect_left(ends, start-1)
+        j = bisect.bisect_right(starts, end+1)
+        if i < j:
+            start = min(start, starts[i])
+            end = max(end, ends[j-1])
+        starts[i:j] = [start]
+        ends[i:j] = [end]
+
+class GraphSnapshot(object):
+    # The first rows of a GraphLayout, as many as there were when the
+    # snapshot was taken. They do not change while the layout goes on.
+    def __init__(self, layout):
+        self.rows = layout.rows
+        self.edges = layout.edges
+        self.edge_blocks = layout.edge_blocks
+        self.count = len(layout.rows)
+        self.edge_count = len(layout.edges)
+        self.columns = layout.columns
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, y):
+        if y >= self.count:
+            raise IndexError, y
+        return self.rows[y]
+
+    def rows_in(self, start, end):
+        # Nodes of rows start..end (exclusive)
+        return self.rows[start:min(end, self.count)]
+
+    def edges_in_rows(self, start, end):
+        # Edges that cross any of the rows start..end (inclusive)
+        result = set()
+        count = self.count
+        for block in xrange(start / EDGE_BLOCK_ROWS, min(end / EDGE_BLOCK_ROWS + 1, len(self.edge_blocks))):
+            for edge in self.edge_blocks[block]:
+                if edge.dst.y < end and start <= edge.src.y < count:
+                    result.add(edge)
+        return result
+
+    def row_width(self, y):
+        # Number of columns up to the rightmost edge that crosses row y
+        # (0 if there is no such edge)
+        width = 0
+        count = self.count
+        block = y / EDGE_BLOCK_ROWS
+        if block < len(self.edge_blocks):
+            for edge in self.edge_blocks[block]:
+                if edge.dst.y < y <= edge.src.y < count and edge.x >= width:
+                    width = edge.x + 1
+        return width
@@ -0,0 +1,535 @@
+import os
+import os.path
+import mmap
+import zlib
+import struct
+import binascii
+import threading
+import collections
+
+# Bases of deltas are kept in memory up to this size (like git's
+# core.deltaBaseCacheLimit), objects in a delta chain are often read
+# one after another.
+DELTA_BASE_CACHE_SIZE = 16 * 1024 * 1024
+
+# Compressed data is read from the pack in chunks of this size
+INFLATE_CHUNK_SIZE = 65536
+
+OBJ_COMMIT    = 1
+OBJ_TREE      = 2
+OBJ_BLOB      = 3
+OBJ_TAG       = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_NAMES = {
+    OBJ_COMMIT: 'commit',
+    OBJ_TREE:   'tree',
+    OBJ_BLOB:   'blob',
+    OBJ_TAG:    'tag'
+}
+
+class ObjectDatabaseError(RuntimeError): pass
+
+class PackIndex(object):
+    # A .idx file (version 1 or 2), mapped into memory. Objects are found
+    # with the fanout table and a binary search in the sorted sha1 table.
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        data = self.data
+        if data[:4] == '\377tOc':
+            version = struct.unpack('>I', data[4:8])[0]
+            if version != 2:
+                raise ObjectDatabaseError, "Unsupported pack index version: %d" % version
+            self.version = 2
+            fanout_pos = 8
+        else:
+            self.version = 1
+            fanout_pos = 0
+
+        self.fanout = struct.unpack('>256I', data[fanout_pos:fanout_pos+1024])
+        self.count = self.fanout[255]
+
+        if self.version == 2:
+            self.sha_pos = fanout_pos + 1024
+            self.offset_pos = self.sha_pos + 24 * self.count # sha1s and CRCs
+            self.large_offset_pos = self.offset_pos + 4 * self.count
+        else:
+            self.entry_pos = fanout_pos + 1024
+
+    def close(self):
+        self.data.close()
+
+    def find(self, binsha):
+        # Returns the offset of an object in the pack or None
+        first = ord(binsha[0])
+        lo = self.fanout[first-1] if first else 0
+        hi = self.fanout[first]
+
+        data = self.data
+        if self.version == 2:
+            pos, size = self.sha_pos, 20
+        else:
+            pos, size = self.entry_pos + 4, 24
+
+        while lo < hi:
+            mid = (lo + hi) / 2
+            start = pos + size * mid
+            sha = data[start:start+20]
+            if sha < binsha:
+                lo = mid + 1
+            elif sha > binsha:
+                hi = mid
+            else:
+                return self._offset(mid)
+
+        return None
+
+    def _offset(self, i):
+        data = self.data
+        if self.version == 1:
+            start = self.entry_pos + 24 * i
+            return struct.unpack('>I', data[start:start+4])[0]
+
+        start = self.offset_pos + 4 * i
+        offset = struct.unpack('>I', data[start:start+4])[0]
+        if offset & 0x80000000:
+            # Packs over 2 GB store large offsets in a separate table
+            start = self.large_offset_pos + 8 * (offset & 0x7fffffff)
+            offset = struct.unpack('>Q', data[start:start+8])[0]
+        return offset
+
+class Pack(object):
+    # A .pack file with its index, mapped into memory
+    def __init__(self, idx_path, pack_path):
+        self.path = pack_path
+        self.index = PackIndex(idx_path)
+
+        f = open(pack_path, 'rb')
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        if self.data[:4] != 'PACK':
+            self.close()
+            raise ObjectDatabaseError, "Invalid pack file: %s" % pack_path
+
+    def close(self):
+        self.index.close()
+        self.data.close()
+
+    def header(self, offset):
+        # Returns (type, size, position of data) of the object at offset.
+        # For delta objects size is the size of the delta.
+        data = self.data
+        c = ord(data[offset])
+        objtype = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        pos = offset + 1
+        while c & 0x80:
+            c = ord(data[pos])
+            size |= (c & 0x7f) << shift
+            shift += 7
+            pos += 1
+
+        return objtype, size, pos
+
+    def ofs_delta_base(self, offset, pos):
+        # Returns (offset of the base object, position of delta data)
+        data = self.data
+        c = ord(data[pos])
+        distance = c & 0x7f
+        pos += 1
+        while c & 0x80:
+            c = ord(data[pos])
+            distance = ((distance + 1) << 7) | (c & 0x7f)
+            pos += 1
+
+        return offset - distance, pos
+
+    def inflate(self, pos, size, partial=False):
+        # Decompresses size bytes of data starting at pos. If partial is
+        # True, the result may be shorter (but never empty for size > 0).
+        d = zlib.decompressobj()
+        chunks = []
+        length = 0
+
+        # Compressed data is rarely much larger than the original
+        chunk_size = min(size + 1024, INFLATE_CHUNK_SIZE)
+        while length < size:
+            compressed = self.data[pos:pos+chunk_size]
+            if not compressed:
+                raise ObjectDatabaseError, "Truncated pack file: %s" % self.path
+            pos += len(compressed)
+            chunk_size = INFLATE_CHUNK_SIZE
+
+            try:
+                chunk = d.decompress(compressed)
+            except zlib.error, msg:
+                raise ObjectDatabaseError, "Corrupt object in %s: %s" % (self.path, msg)
+
+            chunks.append(chunk)
+            length += len(chunk)
+            if partial and length:
+                break
+            if d.unused_data:
+                break
+
+        if length < size and not partial:
+            raise ObjectDatabaseError, "Corrupt object in %s" % self.path
+
+        return ''.join(chunks)
+
+def delta_header_size(delta, pos):
+    # Sizes in the delta header are variable length integers
+    size = 0
+    shift = 0
+    while True:
+        c = ord(delta[pos])
+        pos += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return size, pos
+
+def apply_delta(base, delta):
+    # Builds an object from its base and a git delta: a list of
+    # "copy from base" and "insert new data" instructions
+    src_size, pos = delta_header_size(delta, 0)
+    dst_size, pos = delta_header_size(delta, pos)
+    if src_size != len(base):
+        raise ObjectDatabaseError, "Delta does not match its base object"
+
+    result = []
+    end = len(delta)
+    while pos < end:
+        c = ord(delta[pos])
+        pos += 1
+        if c & 0x80:
+            offset = size = 0
+            if c & 0x01:
+                offset = ord(delta[pos]); pos += 1
+            if c & 0x02:
+                offset |= ord(delta[pos]) << 8; pos += 1
+            if c & 0x04:
+                offset |= ord(delta[pos]) << 16; pos += 1
+            if c & 0x08:
+                offset |= ord(delta[pos]) << 24; pos += 1
+            if c & 0x10:
+                size = ord(delta[pos]); pos += 1
+            if c & 0x20:
+                size |= ord(delta[pos]) << 8; pos += 1
+            if c & 0x40:
+                size |= ord(delta[pos]) << 16; pos += 1
+            if size == 0:
+                size = 0x10000
+            result.append(base[offset:offset+size])
+        elif c:
+            result.append(delta[pos:pos+c])
+            pos += c
+        else:
+            raise ObjectDatabaseError, "Invalid delta instruction"
+
+    result = ''.join(result)
+    if len(result) != dst_size:
+        raise ObjectDatabaseError, "Delta produced an object of wrong size"
+    return result
+
+class ObjectDatabase(object):
+    # Reads objects directly from .git/objects: from pack files and loose
+    # object files (and from alternate object directories), without
+    # starting git. Only objects given by their sha1 id can be read.
+    #
+    # read() and info() return None for objects that are not found, so
+    # the caller can fall back to git cat-file. Pack files are mapped into
+    # memory until close() is called. After that nothing is found: threads
+    # that are still running must not map the packs again.
+    def __init__(self, objects_dir):
+        self.objects_dir = objects_dir
+        self.closed = False
+        self.dirs = None
+        self.packs = []
+        self.pack_stamps = None
+
+        self.base_cache = {} # (pack, offset) => (type, data, last use)
+        self.base_cache_uses = collections.deque() # (key, use), oldest first
+        self.base_cache_use = 0
+        self.base_cache_size = 0
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self._close_packs()
+            self.dirs = None
+            self.closed = True
+        finally:
+            self.lock.release()
+
+    def packed_object_count(self):
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return 0
+            if self.dirs == None:
+                self._scan_packs()
+            return sum([ pack.index.count for pack in self.packs ])
+        finally:
+            self.lock.release()
+
+    def read(self, sha1):
+        # Returns (sha1, type, content) or None
+        self.lock.acquire()
+        try:
+            location = self._find(sha1)
+            if not location:
+                return None
+
+            if location[0] == None:
+                objtype, content = self._read_loose(location[1])
+            else:
+                objtype, content = self._read_packed(*location)
+            return (sha1, objtype, content)
+        finally:
+            self.lock.release()
+
+    def info(self, sha1):
+        # Returns (sha1, type, size) or None, like git cat-file --batch-check
+        self.lock.acquire()
+        try:
+            location = self._find(sha1)
+            if not location:
+                return None
+
+            if location[0] == None:
+                objtype, content = self._read_loose(location[1])
+                return (sha1, objtype, len(content))
+
+            pack, offset = location
+            objtype, size, pos = pack.header(offset)
+            if objtype in TYPE_NAMES:
+                return (sha1, TYPE_NAMES[objtype], size)
+
+            # Size of a delta object is in the header of the delta, its
+            # type is the type of the base at the end of the chain
+            if objtype == OBJ_OFS_DELTA:
+                base = pack.ofs_delta_base(offset, pos)
+                delta = pack.inflate(base[1], size, partial=True)
+            else:
+                delta = pack.inflate(pos + 20, size, partial=True)
+            src_size, delta_pos = delta_header_size(delta, 0)
+            dst_size, delta_pos = delta_header_size(delta, delta_pos)
+
+            return (sha1, self._base_type(pack, offset), dst_size)
+        finally:
+            self.lock.release()
+
+    def _find(self, sha1):
+        # Returns (pack, offset) or (None, path of loose object) or None
+        if self.closed or len(sha1) != 40:
+            return None
+        try:
+            binsha = binascii.unhexlify(sha1)
+        except TypeError:
+            return None
+
+        for rescan in [False, True]:
+            # New packs appear after fetch or gc
+            if rescan or self.dirs == None:
+                if not self._scan_packs():
+                    continue
+
+            for pack in self.packs:
+                offset = pack.index.find(binsha)
+                if offset != None:
+                    return (pack, offset)
+
+            for dir in self.dirs:
+                path = os.path.join(dir, sha1[:2], sha1[2:])
+                if os.path.isfile(path):
+                    return (None, path)
+
+        return None
+
+    def _scan_packs(self):
+        # Returns False if the packs have not changed since the last scan
+        dirs = self._object_dirs()
+        stamps = []
+        for dir in dirs:
+            try:
+                st = os.stat(os.path.join(dir, 'pack'))
+                stamps.append((st.st_mtime, st.st_ino))
+            except OSError:
+                stamps.append(None)
+
+        if self.dirs == dirs and self.pack_stamps == stamps:
+            return False
+
+        self._close_packs()
+        self.dirs = dirs
+        self.pack_stamps = stamps
+
+        for dir in dirs:
+            pack_dir = os.path.join(dir, 'pack')
+            try:
+                names = sorted(os.listdir(pack_dir))
+            except OSError:
+                continue
+
+            for name in names:
+                if not name.endswith('.idx'):
+                    continue
+
+                pack_path = os.path.join(pack_dir, name[:-4] + '.pack')
+                try:
+                    self.packs.append(Pack(os.path.join(pack_dir, name), pack_path))
+                except (IOError, OSError, ValueError, struct.error, mmap.error, ObjectDatabaseError):
+                    pass
+
+        return True
+
+    def _object_dirs(self):
+        # The object directory and its alternates (recursively)
+        dirs = []
+        pending = [self.objects_dir]
+        while pending:
+            dir = os.path.normpath(pending.pop(0))
+            if dir in dirs or not os.path.isdir(dir):
+                continue
+            dirs.append(dir)
+
+            try:
+                f = open(os.path.join(dir, 'info', 'alternates'))
+                lines = f.read().split('\n')
+                f.close()
+            except (IOError, OSError):
+                continue
+
+            for line in lines:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    pending.append(os.path.join(dir, line))
+
+        return dirs
+
+    def _close_packs(self):
+        # Mapped files cannot be deleted on Windows: git gc must be able
+        # to remove old packs
+        for pack in self.packs:
+            pack.close()
+        self.packs = []
+        self.pack_stamps = None
+        self.base_cache.clear()
+        self.base_cache_uses.clear()
+        self.base_cache_size = 0
+
+    def _read_loose(self, path):
+        try:
+            f = open(path, 'rb')
+            data = f.read()
+            f.close()
+            data = zlib.decompress(data)
+        except (IOError, OSError, zlib.error), msg:
+            raise ObjectDatabaseError, "Cannot read object %s: %s" % (path, msg)
+
+        header, _, content = data.partition('\x00')
+        objtype = header.split(' ')[0]
+        return objtype, content
+
+    def _locate_base(self, binsha):
+        for pack in self.packs:
+            offset = pack.index.find(binsha)
+            if offset != None:
+                return (pack, offset)
+
+        raise ObjectDatabaseError, "Base object not found: %s" % binascii.hexlify(binsha)
+
+    def _base_type(self, pack, offset):
+        while True:
+            objtype, size, pos = pack.header(offset)
+            if objtype == OBJ_OFS_DELTA:
+                offset = pack.ofs_delta_base(offset, pos)[0]
+            elif objtype == OBJ_REF_DELTA:
+                pack, offset = self._locate_base(pack.data[pos:pos+20])
+            elif objtype in TYPE_NAMES:
+                return TYPE_NAMES[objtype]
+            else:
+                raise ObjectDatabaseError, "Unknown object type %d in %s" % (objtype, pack.path)
+
+    def _read_packed(self, pack, offset):
+        # Follow the delta chain down to a base that is in the cache or
+        # stored as a whole, then apply the deltas in reverse order
+        deltas = [] # (pack, offset, delta data)
+        while True:
+            cached = self.base_cache.get((pack, offset))
+            if cached:
+                objtype, content, use = cached
+                self._use_base((pack, offset))
+                break
+
+            objtype, size, pos = pack.header(offset)
+            if objtype == OBJ_OFS_DELTA:
+                base_offset, pos = pack.ofs_delta_base(offset, pos)
+                deltas.append((pack, offset, pack.inflate(pos, size)))
+                offset = base_offset
+            elif objtype == OBJ_REF_DELTA:
+                base_sha = pack.data[pos:pos+20]
+                deltas.append((pack, offset, pack.inflate(pos + 20, size)))
+                pack, offset = self._locate_base(base_sha)
+            elif objtype in TYPE_NAMES:
+                objtype = TYPE_NAMES[objtype]
+                content = pack.inflate(pos, size)
+                break
+            else:
+                raise ObjectDatabaseError, "Unknown object type %d in %s" % (objtype, pack.path)
+
+        # Every object that serves as a base is cached
+        base_key = (pack, offset)
+        for pack, offset, delta in reversed(deltas):
+            self._cache_base(base_key, objtype, content)
+            content = apply_delta(content, delta)
+            base_key = (pack, offset)
+
+        return objtype, content
+
+    def _cache_base(self, key, objtype, content):
+        # Least recently used bases are dropped first. Every use is queued,
+        # queue entries of bases that have been used again are skipped.
+        if key in self.base_cache:
+            # Marked as used when it was found in the cache
+            return
+
+        if len(content) > DELTA_BASE_CACHE_SIZE / 4:
+            return
+
+        self.base_cache_use += 1
+        use = self.base_cache_use
+        self.base_cache[key] = (objtype, content, use)
+        self.base_cache_uses.append((key, use))
+        self.base_cache_size += len(content)
+        while self.base_cache_size > DELTA_BASE_CACHE_SIZE:
+            old_key, old_use = self.base_cache_uses.popleft()
+            old = self.base_cache.get(old_key)
+            if old and old[2] == old_use:
+                del self.base_cache[old_key]
+                self.base_cache_size -= len(old[1])
+
+    def _use_base(self, key):
+        # Moves a cached base to the recently used end of the queue
+        self.base_cache_use += 1
+        objtype, content, old_use = self.base_cache[key]
+        self.base_cache[key] = (objtype, content, self.base_cache_use)
+        self.base_cache_uses.append((key, self.base_cache_use))
+        if len(self.base_cache_uses) > 2 * len(self.base_cache) + 64:
+            self._compact_base_uses()
+
+    def _compact_base_uses(self):
+        entries = sorted(self.base_cache.items(), key=lambda item: item[1][2])
+        self.base_cache_uses = collections.deque([ (key, value[2]) for key, value in entries ])
@@ -20,12 +20,20 @@ def init():
         else:
             platform = 'other'
 
-# Init platform-specific values
+# Init platform-specific values. They are queried once, reset() makes
+# the next call query them again.
 def init_wx():
     global default_font
-        
+
     # Fonts
-    default_font = wx.SystemSettings_GetFont(wx.SYS_DEFAULT_GUI_FONT)
+    if not default_font:
+        default_font = wx.SystemSettings_GetFont(wx.SYS_DEFAULT_GUI_FONT)
+
+# Forget the platform-specific values after the system settings changed
+def reset():
+    global default_font
+
+    default_font = None
 
 # Font creator that solves the headache with pixel sizes
 # - in most cases...
@@ -0,0 +1,215 @@
+import os
+import os.path
+import time
+import threading
+
+# Directory and file timestamps that are this close to the time of reading
+# may be changed again without changing the timestamp, so they are not
+# trusted when the cache is validated next time.
+RACY_INTERVAL = 2
+
+class RefStoreError(RuntimeError): pass
+
+class RefStore(object):
+    # Reads references directly from .git/packed-refs and .git/refs.
+    # Results are cached and revalidated with the modification times
+    # of packed-refs and the directories under refs/, so reloading an
+    # unchanged repository does not read any ref files at all.
+    #
+    # In linked worktrees HEAD is stored in git_dir while refs are shared
+    # with the main repository in common_dir.
+    def __init__(self, git_dir, common_dir=None):
+        self.git_dir = git_dir
+        self.common_dir = common_dir or git_dir
+
+        self.packed_stamp = False # not read yet
+        self.packed_refs = {}
+        self.packed_peeled = {}
+
+        self.loose_dirs = {} # directory => (stamp, {refname: value}, [subdirs])
+
+        self.last_result = None
+        self.lock = threading.Lock()
+
+    def supported(self):
+        # The reftable ref storage cannot be read by this class
+        return not os.path.isdir(os.path.join(self.common_dir, 'reftable'))
+
+    def load(self):
+        # Returns (refs, peeled) where refs maps refnames to sha1 ids and
+        # peeled maps annotated tags to the sha1 of the object they point to
+        # (if it is known from packed-refs).
+        if not self.supported():
+            raise RefStoreError, "Unsupported ref storage"
+
+        # Submodules read the HEAD of their parent from other threads
+        self.lock.acquire()
+        try:
+            return self._load()
+        finally:
+            self.lock.release()
+
+    def _load(self):
+        packed_changed = self._load_packed_refs()
+        loose_changed = self._load_loose_dir(os.path.join(self.common_dir, 'refs'), 'refs/')
+
+        if self.last_result and not packed_changed and not loose_changed:
+            return self.last_result
+
+        # Merge loose refs into packed refs: loose refs take precedence
+        refs = dict(self.packed_refs)
+        for stamp_, dir_refs, subdirs in self.loose_dirs.itervalues():
+            refs.update(dir_refs)
+
+        peeled = {}
+        for refname, value in refs.iteritems():
+            if refname in self.packed_peeled and value == self.packed_refs[refname]:
+                peeled[refname] = self.packed_peeled[refname]
+
+        # Resolve symbolic refs (e.g. refs/remotes/origin/HEAD)
+        for refname, value in refs.items():
+            target = self._resolve(refs, value)
+            if target:
+                refs[refname] = target
+            else:
+                del refs[refname]
+
+        self.last_result = (refs, peeled)
+        return self.last_result
+
+    def fingerprint(self):
+        # Changes whenever HEAD, packed-refs, any directory of loose refs
+        # or the reflog of HEAD is modified. The config is included too:
+        # upstreams of branches come from branch.*.merge.
+        stamps = [ self._stamp(os.path.join(self.git_dir, f)) for f in ['HEAD', os.path.join('logs', 'HEAD')] ]
+        stamps.append(self._stamp(os.path.join(self.common_dir, 'packed-refs')))
+        stamps.append(self._stamp(os.path.join(self.common_dir, 'config')))
+        for dir in sorted(self.loose_dirs.iterkeys()):
+            stamps.append(self._stamp(dir))
+        if not self.loose_dirs:
+            stamps.append(self._stamp(os.path.join(self.common_dir, 'refs')))
+
+        return tuple(stamps)
+
+    def read_head(self):
+        # Returns the content of HEAD: either 'ref: <refname>' or a sha1 id
+        try:
+            f = open(os.path.join(self.git_dir, 'HEAD'))
+            head = f.read().strip()
+            f.close()
+            return head
+        except (IOError, OSError):
+            return None
+
+    def _resolve(self, refs, value):
+        # Follow symbolic refs (at most a few levels, like git does)
+        for i in xrange(5):
+            if not value.startswith('ref: '):
+                return value
+            value = refs.get(value[5:].strip())
+            if value == None:
+                return None
+        return None
+
+    def _stamp(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        # Racy timestamps never match a stored stamp
+        if time.time() - st.st_mtime < RACY_INTERVAL:
+            return (st.st_mtime, st.st_size, st.st_ino, time.time())
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def _load_packed_refs(self):
+        path = os.path.join(self.common_dir, 'packed-refs')
+        stamp = self._stamp(path)
+        if stamp == self.packed_stamp:
+            return False
+
+        self.packed_stamp = stamp
+        self.packed_refs = {}
+        self.packed_peeled = {}
+
+        if stamp == None:
+            return True
+
+        try:
+            f = open(path)
+            lines = f.read().split('\n')
+            f.close()
+        except (IOError, OSError):
+            self.packed_stamp = False
+            return True
+
+        last_ref = None
+        for line in lines:
+            if not line or line.startswith('#'):
+                continue
+            elif line.startswith('^'):
+                if last_ref:
+                    self.packed_peeled[last_ref] = line[1:].strip()
+            else:
+                sha1, _, refname = line.partition(' ')
+                refname = refname.strip()
+                self.packed_refs[refname] = sha1
+                last_ref = refname
+
+        return True
+
+    def _load_loose_dir(self, dir, prefix):
+        # Returns True if anything changed in dir or in its subdirectories
+        stamp = self._stamp(dir)
+        cached = self.loose_dirs.get(dir)
+        changed = False
+
+        if stamp == None:
+            self._forget_dir(dir)
+            return cached != None
+
+        if cached and cached[0] == stamp:
+            dir_refs, subdirs = cached[1], cached[2]
+        else:
+            changed = True
+            dir_refs, subdirs = {}, []
+
+            try:
+                names = os.listdir(dir)
+            except OSError:
+                names = []
+
+            for name in names:
+                path = os.path.join(dir, name)
+                if os.path.isdir(path):
+                    subdirs.append(name)
+                elif not name.endswith('.lock'):
+                    try:
+                        f = open(path)
+                        value = f.read().strip()
+                        f.close()
+                    except (IOError, OSError):
+                        continue
+
+                    if value:
+                        dir_refs[prefix + name] = value
+
+            # Forget subdirectories that have been removed
+            if cached:
+                for name in cached[2]:
+                    if name not in subdirs:
+                        self._forget_dir(os.path.join(dir, name))
+
+            self.loose_dirs[dir] = (stamp, dir_refs, subdirs)
+
+        for name in subdirs:
+            if self._load_loose_dir(os.path.join(dir, name), prefix + name + '/'):
+                changed = True
+
+        return changed
+
+    def _forget_dir(self, dir):
+        cached = self.loose_dirs.pop(dir, None)
+        if cached:
+            for name in cached[2]:
+                self._forget_dir(os.path.join(dir, name))
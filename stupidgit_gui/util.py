@@ -3,6 +3,10 @@ import sys
 import os
 import os.path
 import subprocess
+import time
+import threading
+import collections
+import atexit
 if sys.platform == 'win32':
     import ctypes
 
@@ -48,6 +52,73 @@ def invert_hash(h):
 
     return ih
 
+def read_sha1_file(filename):
+    # Returns the sha1 id stored in a file like .git/MERGE_HEAD or None
+    try:
+        f = open(filename)
+        sha1 = f.readline().strip()
+        f.close()
+    except (IOError, OSError):
+        return None
+
+    if len(sha1) == 40:
+        return sha1
+    else:
+        return None
+
+def _plural(n, word):
+    if n == 1:
+        return '%d %s' % (n, word)
+    else:
+        return '%d %ss' % (n, word)
+
+def format_relative_date(timestamp, now=None):
+    # Same text as git log --date=relative
+    if now == None:
+        now = time.time()
+
+    diff = int(now) - timestamp
+    if diff < 0:
+        return 'in the future'
+
+    if diff < 90:
+        return _plural(diff, 'second') + ' ago'
+    diff = (diff + 30) / 60
+    if diff < 90:
+        return _plural(diff, 'minute') + ' ago'
+    diff = (diff + 30) / 60
+    if diff < 36:
+        return _plural(diff, 'hour') + ' ago'
+    diff = (diff + 12) / 24
+    if diff < 14:
+        return _plural(diff, 'day') + ' ago'
+    if diff < 70:
+        return _plural((diff + 3) / 7, 'week') + ' ago'
+    if diff < 365:
+        return _plural((diff + 15) / 30, 'month') + ' ago'
+    if diff < 1825:
+        total_months = (diff * 12 * 2 + 365) / (365 * 2)
+        years = total_months / 12
+        months = total_months % 12
+        if months:
+            return '%s, %s ago' % (_plural(years, 'year'), _plural(months, 'month'))
+        else:
+            return _plural(years, 'year') + ' ago'
+    return _plural((diff + 183) / 365, 'year') + ' ago'
+
+WEEKDAY_NAMES = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+MONTH_NAMES = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+def format_date(timestamp, tz_offset):
+    # Same text as git log --date=default, in the timezone of the commit
+    # (tz_offset is in minutes east of UTC). Names are not localized.
+    t = time.gmtime(timestamp + tz_offset * 60)
+    sign = '-' if tz_offset < 0 else '+'
+    return '%s %s %d %02d:%02d:%02d %d %s%02d%02d' % (
+        WEEKDAY_NAMES[t.tm_wday], MONTH_NAMES[t.tm_mon-1], t.tm_mday,
+        t.tm_hour, t.tm_min, t.tm_sec, t.tm_year,
+        sign, abs(tz_offset) / 60, abs(tz_offset) % 60)
+
 def find_binary(locations):
     searchpath_sep = ';' if sys.platform == 'win32' else ':'
     searchpaths = os.environ['PATH'].split(searchpath_sep)
@@ -115,3 +186,123 @@ def Popen(cmd, **args):
 
     return process
 
+
+class Future(object):
+    # Result of a function that is executed by a WorkerPool
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.started = False
+        self.value = None
+        self.error = None
+
+    def run(self):
+        # Returns False if the function is already being run by someone else
+        self.lock.acquire()
+        try:
+            if self.started:
+                return False
+            self.started = True
+        finally:
+            self.lock.release()
+
+        try:
+            self.value = self.func(*self.args, **self.kwargs)
+        except Exception, e:
+            self.error = (e, sys.exc_info()[2])
+
+        self.func = self.args = self.kwargs = None
+        self.finished.set()
+        return True
+
+    def done(self):
+        return self.finished.isSet()
+
+    def result(self):
+        # If no worker has picked up the job yet, run it in the calling
+        # thread. This way waiting for a future from a worker thread cannot
+        # deadlock the pool.
+        self.run()
+        self.finished.wait()
+
+        if self.error:
+            raise self.error[0], None, self.error[1]
+        return self.value
+
+# At exit, workers that are still running a job get this long (in seconds)
+# to finish it. A long git command must not keep the application open.
+WORKER_EXIT_TIMEOUT = 1.0
+
+class WorkerPool(object):
+    # A bounded pool of daemon threads. Threads are started on demand.
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.workers = []
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.idle = 0
+        self.stopped = False
+
+        # Daemon threads that are still waiting at interpreter shutdown
+        # would print spurious errors
+        atexit.register(self.shutdown, WORKER_EXIT_TIMEOUT)
+
+    def submit(self, func, *args, **kwargs):
+        future = Future(func, args, kwargs)
+
+        self.cond.acquire()
+        try:
+            self.queue.append(future)
+            if self.idle == 0 and len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self._worker)
+                worker.setDaemon(True)
+                self.workers.append(worker)
+                worker.start()
+            else:
+                self.cond.notify()
+        finally:
+            self.cond.release()
+
+        return future
+
+    def map(self, func, items):
+        futures = [ self.submit(func, item) for item in items ]
+        return [ f.result() for f in futures ]
+
+    def shutdown(self, timeout=None):
+        # Stops the workers after their current job. With a timeout, waits
+        # at most that long in total: busy workers are left running.
+        self.cond.acquire()
+        try:
+            self.stopped = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+        if timeout != None:
+            deadline = time.time() + timeout
+        for worker in self.workers:
+            if timeout != None:
+                worker.join(max(0, deadline - time.time()))
+            else:
+                worker.join()
+
+    def _worker(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.queue and not self.stopped:
+                    self.idle += 1
+                    self.cond.wait()
+                    self.idle -= 1
+                if self.stopped:
+                    return
+                future = self.queue.popleft()
+            finally:
+                self.cond.release()
+
+            future.run()